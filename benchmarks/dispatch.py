@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Measures the cost of dispatching one ready socket to its connection in IRC.process_data.
+
+The old implementation compared the ready socket with the socket of every connection, the new one looks it up in the reactor."""
+
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import irclib
+
+
+class FakeSocket:
+
+	def __init__(self, fd):
+		self.fd = fd
+
+	def fileno(self):
+		return self.fd
+
+
+def legacy_process_data(irc, sockets):
+	for s in sockets:
+		for c in irc.connections:
+			if s == c._get_socket():
+				c.lock.acquire()
+				if hasattr(c, 'socket'):
+					c.process_data()
+				c.lock.release()
+
+
+def setup(n):
+	irc = irclib.IRC(reactor=irclib.SelectReactor())
+	for i in xrange(n):
+		c = irclib.ServerConnection(irc, 'irc.example.org', 6667, 'nick%d' % i)
+		c.socket = FakeSocket(1000+i)
+		c.process_data = lambda: None
+		irc.connections.append(c)
+		irc._register_socket(c)
+	# the ready socket is the last one, worst case for the linear scan
+	return irc, [irc.connections[-1].socket]
+
+
+def main():
+	number = 200
+	print '%8s %16s %16s' % ('conns', 'legacy (us)', 'reactor (us)')
+	for n in [10, 100, 1000, 5000]:
+		irc, ready = setup(n)
+		legacy = min(timeit.repeat(lambda: legacy_process_data(irc, ready), number=number, repeat=3))
+		new = min(timeit.repeat(lambda: irc.process_data(ready), number=number, repeat=3))
+		print '%8d %16.2f %16.2f' % (n, legacy/number*1e6, new/number*1e6)
+
+
+if __name__ == '__main__':
+	main()
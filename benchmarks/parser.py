@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Measures the number of lines per second parsed by ServerConnection.process_data.
+
+The corpus is generated with a fixed seed to mimic the traffic of a busy channel (mostly plain messages, some actions, formatting codes, joins, parts, quits, nick and mode changes, notices and pings), no recording of real traffic is shipped with xib.
+
+The old parser is kept below for comparison, the events produced by both are checked to be identical."""
+
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import irclib
+
+
+class FakeBot:
+
+	def error(self, *args, **kwargs):
+		pass
+
+
+class FakeSocket:
+
+	def __init__(self, data):
+		self.data = data
+		self.offset = 0
+
+	def recv(self, size):
+		chunk = self.data[self.offset:self.offset+size]
+		self.offset += size
+		return chunk
+
+
+words = ['hello', 'the', 'bridge', 'is', 'down', 'again', 'xmpp', 'irc', 'lol', 'why', 'not', 'patch', 'merged', 'thanks', u'\xe7a', u'marche', u'd\xe9j\xe0', u'\u043f\u0440\u0438\u0432\u0435\u0442', 'http://example.org/', ':)', ':', 'a']
+nicks = ['alice', 'bob', 'carol', 'dave', 'eve', 'mallory', 'trent', 'peggy']
+
+
+def text(r):
+	return ' '.join([r.choice(words) for i in xrange(r.randint(1, 20))])
+
+
+def corpus(n):
+	"""Returns n lines of generated IRC traffic as a UTF-8 string."""
+	r = random.Random(42)
+	lines = []
+	for i in xrange(n):
+		nick = r.choice(nicks)
+		source = ':%s!~%s@host-%d.example.net' % (nick, nick, r.randint(1, 50))
+		x = r.random()
+		if x < 0.70:
+			line = source+' PRIVMSG #xib :'+text(r)
+		elif x < 0.75:
+			line = source+' PRIVMSG #xib :\x02'+text(r)+'\x02 \x0304,01'+text(r)+'\x03 \x1f'+text(r)
+		elif x < 0.80:
+			line = source+' PRIVMSG #xib :\x01ACTION '+text(r)+'\x01'
+		elif x < 0.83:
+			line = source+' JOIN :#xib'
+		elif x < 0.86:
+			line = source+' PART #xib :'+text(r)
+		elif x < 0.89:
+			line = source+' QUIT :Quit: '+text(r)
+		elif x < 0.91:
+			line = source+' NICK :'+r.choice(nicks)+'_'
+		elif x < 0.93:
+			line = source+' MODE #xib +v '+r.choice(nicks)
+		elif x < 0.96:
+			line = source+' NOTICE #xib :'+text(r)
+		else:
+			line = 'PING :irc.example.net'
+		lines.append(line)
+	return (u'\r\n'.join(lines)+u'\r\n').encode('utf-8')
+
+
+def legacy_process_data(c, new_data):
+	lines = irclib._linesep_regexp.split(c.previous_buffer + new_data)
+	
+	# Save the last, unfinished line.
+	c.previous_buffer = lines.pop()
+	
+	for line in lines:
+		if irclib.DEBUG:
+			print "FROM SERVER:", line
+		
+		if not line:
+			continue
+		
+		line = c._decode(line)
+		
+		prefix = None
+		command = None
+		arguments = None
+		c._handle_event(irclib.Event("all_raw_messages",
+								 c.get_server_name(),
+								 None,
+								 [line]))
+		
+		m = irclib._rfc_1459_command_regexp.match(line)
+		if m.group("prefix"):
+			prefix = m.group("prefix")
+			if not c.real_server_name:
+				c.real_server_name = prefix
+		
+		if m.group("command"):
+			command = m.group("command").lower()
+		
+		if m.group("argument"):
+			a = m.group("argument").split(" :", 1)
+			arguments = a[0].split()
+			if len(a) == 2:
+				arguments.append(a[1])
+		
+		# Translate numerics into more readable strings.
+		if command in irclib.numeric_events:
+			command = irclib.numeric_events[command]
+		
+		if command in ["privmsg", "notice"]:
+			target, message = arguments[0], arguments[1]
+			messages = irclib._ctcp_dequote(message)
+			
+			if command == "privmsg":
+				if irclib.is_channel(target):
+					command = "pubmsg"
+			else:
+				if irclib.is_channel(target):
+					command = "pubnotice"
+				else:
+					command = "privnotice"
+			
+			for m in messages:
+				if type(m) is tuple:
+					if command in ["privmsg", "pubmsg"]:
+						command = "ctcp"
+					else:
+						command = "ctcpreply"
+					
+					m = list(m)
+					if irclib.DEBUG:
+						print "command: %s, source: %s, target: %s, arguments: %s" % (
+							command, prefix, target, m)
+					
+					# Remove formatting
+					for i in range(len(m)):
+						m[i] = irclib.strip_formatting_re.sub('', m[i])
+					
+					c._handle_event(irclib.Event(command, prefix, target, m))
+					if command == "ctcp" and m[0] == "ACTION":
+						c._handle_event(irclib.Event("action", prefix, target, m[1:]))
+				else:
+					if irclib.DEBUG:
+						print "command: %s, source: %s, target: %s, arguments: %s" % (
+							command, prefix, target, [m])
+					c._handle_event(irclib.Event(command, prefix, target, [irclib.strip_formatting_re.sub('', m)]))
+		else:
+			target = None
+			
+			if command == "quit":
+				arguments = [arguments[0]]
+			elif command == "ping":
+				target = arguments[0]
+			else:
+				target = arguments[0]
+				arguments = arguments[1:]
+			
+			if command == "mode":
+				if not irclib.is_channel(target):
+					command = "umode"
+			
+			if command in ["nick", "welcome"]:
+				c.logged_in = True
+				if c.new_nickname and isinstance(target, basestring):
+					c.real_nickname = target
+					if c.new_nickname != target:
+						if len(c.new_nickname) > len(target):
+							c._handle_event(irclib.Event('nicknametoolong', None, None, None))
+						else:
+							c._handle_event(irclib.Event('erroneusnickname', None, None, None))
+					else:
+						c._call_nick_callbacks(None)
+					c.new_nickname = None
+			
+			if command == "join":
+				if c.irc_id != prefix:
+					c.irc_id = prefix
+					if irclib.DEBUG:
+						print "irc_id: %s" % (prefix)
+				channel = target.lower()
+				if c.channels[channel].state != irclib.JOINED:
+					c.channels[channel]._callback(None)
+			
+			if command in ['inviteonlychan', 'bannedfromchan', 'channelisfull', 'badchannelkey']:
+				c.channels[arguments[0].lower()]._callback(command)
+			
+			if irclib.DEBUG:
+				print "command: %s, source: %s, target: %s, arguments: %s" % (
+					command, prefix, target, arguments)
+			
+			# Remove formatting
+			for i in range(len(arguments)):
+				arguments[i] = irclib.strip_formatting_re.sub('', arguments[i])
+			
+			c._handle_event(irclib.Event(command, prefix, target, arguments))
+
+
+def new_connection(irc, data):
+	c = irclib.ServerConnection(irc, 'irc.example.net', 6667, 'xib')
+	c.socket = FakeSocket(data)
+	c.channels['#xib'] = irclib.Channel(c, '#xib')
+	c.channels['#xib'].state = irclib.JOINED
+	return c
+
+
+def run(irc, data, parse):
+	c = new_connection(irc, data)
+	for i in xrange(0, len(data), 2**14):
+		parse(c)
+	return c
+
+
+def main():
+	n = 50000
+	data = corpus(n)
+	irc = irclib.IRC()
+	irc.bot = FakeBot()
+	irc.charsets['irc.example.net:6667'] = ['utf-8', 'iso-8859-15']
+	
+	events = []
+	def record(connection, event):
+		events.append((event.eventtype(), event.source(), event.target(), event.arguments()))
+	irc.add_global_handler('all_events', record)
+	run(irc, data, lambda c: legacy_process_data(c, c.socket.recv(2**14)))
+	legacy_events = events[:]
+	del events[:]
+	run(irc, data, lambda c: c.process_data())
+	if events != legacy_events:
+		print 'the new parser does not produce the same events as the old one'
+		sys.exit(1)
+	irc.remove_global_handler('all_events', record)
+	
+	print '%d lines, %d events' % (n, len(legacy_events))
+	for name, parse in [('legacy', lambda c: legacy_process_data(c, c.socket.recv(2**14))), ('new', lambda c: c.process_data())]:
+		best = None
+		for i in xrange(3):
+			t = time.time()
+			run(irc, data, parse)
+			t = time.time() - t
+			if best is None or t < best:
+				best = t
+		print '%8s %12d lines/s' % (name, n/best)
+
+
+if __name__ == '__main__':
+	main()
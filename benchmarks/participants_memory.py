@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Measures the memory used per participant in a bridge of 10000 idle IRC participants.
+
+The bridge and the bot are measured before and after adding the participants, so the nickname indexes of the bridge and the directory of the bot are counted with the Participant objects. The old Participant was a classic class with a __dict__, the new one uses slots. The nicknames are not counted, they are the same objects in both cases."""
+
+
+import gc
+import os
+import sys
+import threading
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bot
+import bridge
+from participant import Participant
+
+
+class FakeBot(bot.Bot):
+
+	nickname = 'xib'
+
+	def __init__(self):
+		self.participants_by_irc_server = {}
+		self.participants_by_irc_server_lock = threading.Lock()
+
+	def __del__(self):
+		pass
+
+	def error(self, *args, **kwargs):
+		pass
+
+
+class FakeBridge(bridge.Bridge):
+
+	def __init__(self, owner_bot):
+		self.bot = owner_bot
+		self.irc_server = 'irc.example.net'
+		self.participants = []
+		self.participants_by_nickname = {}
+		self.participants_keys = {}
+		self.mode = 'minimal'
+		self.lock = threading.RLock()
+
+	def __del__(self):
+		pass
+
+	def __str__(self):
+		return 'benchmark'
+
+	def show_participants_list_on(self, protocols=[]):
+		pass
+
+
+class LegacyParticipant:
+
+	def __init__(self, owner_bridge, protocol, nickname, real_jid=None):
+		self.bot_admin = False
+		self.real_jid = real_jid
+		self.bridge = owner_bridge
+		self.protocol = protocol
+		self.nickname = nickname
+		self.duplicate_nickname = self.nickname
+		self.irc_connection = None
+		self.xmpp_c = None
+		self.muc = None
+		self.left = False
+
+
+_not_counted = (type, types.ClassType, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType)
+
+
+def size(roots, excluded):
+	"""Returns the size of roots and of all the objects they reach, except classes, functions, modules and the objects in excluded."""
+	seen = set([id(o) for o in excluded])
+	stack = list(roots)
+	total = 0
+	while stack:
+		o = stack.pop()
+		if id(o) in seen or isinstance(o, _not_counted):
+			continue
+		seen.add(id(o))
+		total += sys.getsizeof(o)
+		stack.extend(gc.get_referents(o))
+	return total
+
+
+def measure(participant_class, nicknames):
+	"""Returns the bytes used per participant by a bridge and its bot when nicknames join it."""
+	bridge.Participant = participant_class
+	b = FakeBridge(FakeBot())
+	roots = [b, b.bot]
+	before = size(roots, nicknames)
+	for nickname in nicknames:
+		b.add_participant('irc', nickname)
+	after = size(roots, nicknames)
+	bridge.Participant = Participant
+	return float(after - before)/len(nicknames)
+
+
+def main():
+	n = 10000
+	nicknames = [u'lurker%d' % i for i in xrange(n)]
+	print '%8s %16s %16s' % ('members', 'legacy (B/p)', 'slots (B/p)')
+	print '%8d %16.1f %16.1f' % (n, measure(LegacyParticipant, nicknames), measure(Participant, nicknames))
+
+
+if __name__ == '__main__':
+	main()
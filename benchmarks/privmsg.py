@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Measures the time taken by ServerConnection.privmsg to split pastes of 10 to 100 KB.
+
+The old implementation re-encoded shrinking slices of each line until they fit, the new one encodes each line once and cuts it on character boundaries."""
+
+
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import irclib
+
+
+def legacy_privmsg(c, target, text):
+	for l in text.split('\n'):
+		l_size = len(l.encode('utf-8'))
+		available_size = float(510-len('%s PRIVMSG %s :' % (c.irc_id, target)))  # 510 is the size limit for IRC messages defined in RFC 2812
+		e = 0
+		for i in range(int(math.ceil(l_size/available_size))):
+			s = e
+			e = s+int(available_size)
+			while len(l[s:e].encode('utf-8')) >= available_size:
+				e -= 1
+			c.send_raw("PRIVMSG %s :%s" % (target, l[s:e]))
+
+
+def paste(size, words, newlines):
+	"""Returns about size bytes of text made of words, with a newline every 80 characters or so if newlines is True."""
+	r = random.Random(size)
+	text = []
+	n = 0
+	line = 0
+	while n < size:
+		w = r.choice(words)
+		text.append(w)
+		n += len(w.encode('utf-8'))+1
+		line += len(w)+1
+		if newlines and line > 80:
+			text.append(u'\n')
+			line = 0
+		else:
+			text.append(u' ')
+	return u''.join(text)
+
+
+def main():
+	irc = irclib.IRC()
+	c = irclib.ServerConnection(irc, 'irc.example.net', 6667, 'xib')
+	c.irc_id = u'xib!~xib@bridge.example.net'
+	sent = []
+	c.send_raw = sent.append
+	
+	ascii = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit']
+	accents = [u'\xe9t\xe9', u'd\xe9j\xe0', u'привет', u'日本語', u'€']
+	print '%8s %10s %9s %14s %14s' % ('size', 'text', 'newlines', 'legacy (ms)', 'new (ms)')
+	for size in [10000, 50000, 100000]:
+		for name, words in [('ascii', ascii), ('non-ascii', accents)]:
+			for newlines in [False, True]:
+				text = paste(size, words, newlines)
+				times = []
+				for privmsg in [lambda: legacy_privmsg(c, '#xib', text), lambda: c.privmsg('#xib', text)]:
+					best = None
+					for i in xrange(3):
+						del sent[:]
+						t = time.time()
+						privmsg()
+						t = time.time() - t
+						if best is None or t < best:
+							best = t
+					times.append(best)
+				print '%8d %10s %9s %14.2f %14.2f' % (size, name, newlines, times[0]*1000, times[1]*1000)
+
+
+if __name__ == '__main__':
+	main()
@@ -18,7 +18,7 @@
 import re
 import sys
 import threading
-from time import sleep
+from time import time
 import traceback
 import xml.parsers.expat
 
@@ -27,18 +27,31 @@ import muc
 xmpp = muc.xmpp
 del muc
 
-from bridge import Bridge
+from bridge import Bridge, nickname_key
+from component import ComponentSession, xmpp_connection_types
 from participant import Participant
+import scram
+from stream_management import StreamManagement
 import commands
 import say_levels
 
 
 class Bot(threading.Thread):
 	
-	def __init__(self, jid, password, nickname, admins=[], error_fd=sys.stderr, debug=False):
+	def __init__(self, jid, password, nickname, admins=[], error_fd=sys.stderr, debug=False, component=None, xmpp_pool_size=0):
+		"""Create a new bot.
+		
+		If component is a component.Component object the XMPP duplicates of IRC participants are multiplexed over it instead of each one logging in with the bot's account.
+		
+		Otherwise xmpp_pool_size spare XMPP connections are kept authenticated in the background, so that new duplicates only have to join their rooms."""
 		threading.Thread.__init__(self)
 		self.halt = False
 		self.bridges = []
+		self.bridges_by_irc_room = {}
+		self.bridges_by_irc_server = {}
+		self.bridges_by_xmpp_room_jid = {}
+		self.participants_by_irc_server = {}
+		self.participants_by_irc_server_lock = threading.Lock()
 		self.bare_jid = xmpp.protocol.JID(jid=jid)
 		self.bare_jid.setResource('')
 		self.nickname = nickname
@@ -47,9 +60,19 @@ class Bot(threading.Thread):
 		self.debug = debug
 		self.admins = admins
 		self.xmpp_connections = {}
+		self.xmpp_reactor = irclib.default_reactor()
+		self.xmpp_waker = irclib.Waker()
+		self.xmpp_reactor.register(self.xmpp_waker.fileno(), self.xmpp_waker)
+		self.xmpp_timers = irclib.TimerQueue(self.xmpp_waker)
+		self.xmpp_ping_interval = 60
+		self.component = component
+		self.xmpp_pool = []
+		self.xmpp_pool_size = xmpp_pool_size
+		self.xmpp_pool_condition = threading.Condition()
 		self.irc = irclib.IRC()
 		self.irc.bot = self
 		self.irc.add_global_handler('all_events', self._irc_event_handler)
+		self.irc.fn_send_buffer_full = self._irc_send_buffer_full
 		self.irc_thread = threading.Thread(target=self.irc.process_forever)
 		self.irc_thread.start()
 		# Open connection with XMPP server
@@ -58,8 +81,17 @@ class Bot(threading.Thread):
 		except:
 			self.error(say_levels.error, 'XMPP Connection failed')
 			raise
+		if self.component:
+			try:
+				self.open_component()
+			except:
+				self.error(say_levels.error, 'XMPP component connection failed')
+				raise
 		self.xmpp_thread = threading.Thread(target=self._xmpp_loop)
 		self.xmpp_thread.start()
+		if self.xmpp_pool_size > 0 and not self.component:
+			self.xmpp_pool_thread = threading.Thread(target=self._xmpp_pool_loop)
+			self.xmpp_pool_thread.start()
 	
 	
 	def error(self, importance, message, debug=False, no_debug_add='', send_to_admins=False):
@@ -82,47 +114,118 @@ class Bot(threading.Thread):
 	
 	def _xmpp_loop(self):
 		"""[Internal] XMPP infinite loop."""
-		i = 1
 		while True:
 			if self.halt:
 				s = len(self.xmpp_connections)
 				for i in range(s):
 					self.close_xmpp_connection(self.xmpp_connections.keys()[s-i-1], force=True)
+				if self.component:
+					self._xmpp_unwatch(self.component)
+					self.component.disconnect()
+				self._xmpp_pool_close()
 				break
-			unlock = False
+			timeout = None
+			next_time = self.xmpp_timers.next_time()
+			if next_time != None:
+				timeout = max(0, next_time - time())
+			ready = [c for c, events in self.xmpp_reactor.poll(timeout)]
+			if self.xmpp_waker in ready:
+				ready.remove(self.xmpp_waker)
+				self.xmpp_waker.clear()
+			# the bot connection goes first
+			if self.xmpp_c in ready:
+				ready.remove(self.xmpp_c)
+				ready.insert(0, self.xmpp_c)
+			for c in ready:
+				self._xmpp_process(c)
+			now = time()
+			timer = self.xmpp_timers.pop(now)
+			while timer:
+				timer.function(*timer.arguments)
+				timer = self.xmpp_timers.pop(now)
+	
+	
+	def _xmpp_process(self, c):
+		"""[Internal] Process the data received by the XMPP connection c."""
+		c.lock.acquire()
+		try:
+			if c.Process(0) == None:
+				raise IOError, 'Disconnected from server'
+		except RuntimeError:
+			pass
+		except (xml.parsers.expat.ExpatError, xmpp.protocol.XMLNotWellFormed):
+			self.error(1, 'invalid stanza', debug=True)
+			self.reopen_xmpp_connection(c)
+		except xmpp.Conflict:
+			self.error(1, 'conflict', debug=True)
+			self.reopen_xmpp_connection(c)
+		except IOError:
+			self.error(say_levels.warning, 'XMPP connection for "'+c.nickname+'" lost', send_to_admins=True)
+			# stop watching the dead socket before trying to reconnect
+			self._xmpp_unwatch(c)
 			try:
-				if len(self.xmpp_connections) == 1:
-					sleep(0.5)  # avoid bot connection being locked all the time
-				for j, c in enumerate(self.xmpp_connections.itervalues()):
-					i += 1
-					if hasattr(c, 'lock'):
-						c.lock.acquire()
-						if i == j:
-							ping = xmpp.protocol.Iq(typ='get')
-							ping.addChild(name='ping', namespace='urn:xmpp:ping')
-							self.error(1, 'sending XMPP ping', debug=True)
-							c.pings.append(c.send(ping))
-						if hasattr(c, 'Process'):
-							c.Process(0.01)
-						c.lock.release()
-					if i > 5000:
-						i = 0
-			except RuntimeError:
-				pass
-			except (xml.parsers.expat.ExpatError, xmpp.protocol.XMLNotWellFormed):
-				self.error(1, 'invalid stanza', debug=True)
-				self.reopen_xmpp_connection(c)
-				unlock = True
-			except xmpp.Conflict:
-				self.error(1, 'conflict', debug=True)
-				self.reopen_xmpp_connection(c)
-				unlock = True
+				if c == self.component:
+					c.reconnect()
+				else:
+					self.reopen_xmpp_connection(c)
 			except:
-				error = 'Unknown exception on XMPP thread:\n'+traceback.format_exc()
+				error = 'Failed to reopen XMPP connection for "'+c.nickname+'":\n'+traceback.format_exc()
 				self.error(say_levels.error, error, send_to_admins=True)
-				unlock = True
-			if unlock == True:
-				c.lock.release()
+		except:
+			error = 'Unknown exception on XMPP thread:\n'+traceback.format_exc()
+			self.error(say_levels.error, error, send_to_admins=True)
+		c.lock.release()
+	
+	
+	def _xmpp_watch(self, c):
+		"""[Internal] Make the XMPP loop process c when it receives data, and ping its server regularly."""
+		c.fd = c.Connection._sock.fileno()
+		self.xmpp_reactor.register(c.fd, c)
+		# the XMPP thread may be waiting without watching this socket
+		self.xmpp_waker.wake()
+		c.ping_timer = self.xmpp_timers.add(time() + self.xmpp_ping_interval, self._xmpp_ping, (c,), owner=c)
+	
+	
+	def _xmpp_unwatch(self, c):
+		"""[Internal]"""
+		if c.fd != None and self.xmpp_reactor.data.get(c.fd) is c:
+			self.xmpp_reactor.unregister(c.fd)
+		c.fd = None
+		for timer in list(c.timers):
+			timer.cancel()
+	
+	
+	def open_component(self):
+		"""Connect the component and make the XMPP loop process it."""
+		self.component.lock.acquire()
+		self.component.open()
+		self.component.fn_reconnected = self._xmpp_component_reconnected
+		self._xmpp_watch(self.component)
+		self.component.lock.release()
+	
+	
+	def _xmpp_component_reconnected(self, component):
+		"""[Internal] The socket of the component changed, watch the new one."""
+		self._xmpp_unwatch(component)
+		self._xmpp_watch(component)
+	
+	
+	def _xmpp_ping(self, c):
+		"""[Internal] Ping the server of c and schedule the next ping."""
+		c.lock.acquire()
+		ping = xmpp.protocol.Iq(typ='get')
+		ping.addChild(name='ping', namespace='urn:xmpp:ping')
+		if c is self.component:
+			# the stanzas of a component must be addressed, see XEP-0114
+			ping.setFrom(c.component_jid)
+			ping.setTo(c.server)
+		self.error(1, 'sending XMPP ping', debug=True)
+		try:
+			c.pings.append(c.send(ping))
+		except IOError:
+			pass
+		c.ping_timer = self.xmpp_timers.add(time() + self.xmpp_ping_interval, self._xmpp_ping, (c,), owner=c)
+		c.lock.release()
 	
 	
 	def _xmpp_presence_handler(self, dispatcher, presence):
@@ -216,7 +319,7 @@ class Bot(threading.Thread):
 							if p == None:
 								bridge.xmpp_room.rejoin()
 								return
-							if isinstance(p.xmpp_c, xmpp.client.Client):
+							if isinstance(p.xmpp_c, xmpp_connection_types):
 								p.muc.rejoin()
 							else:
 								if item:
@@ -462,6 +565,11 @@ class Bot(threading.Thread):
 			self.error(say_levels.debug, 'Received XMPP message of unknown type "'+str(message.getType())+'".\n'+message.__str__(fancy=1))
 	
 	
+	def _irc_send_buffer_full(self, connection, size):
+		"""[Internal] Called by irclib when the send buffer of an IRC connection backs up"""
+		self.error(say_levels.warning, 'the send buffer of the IRC connection "'+connection.nickname+'" to "'+connection.server+'" holds '+str(size)+' bytes, the server is not reading fast enough')
+	
+	
 	def _irc_event_handler(self, connection, event):
 		"""[Internal] Manage IRC events"""
 		
@@ -500,18 +608,14 @@ class Bot(threading.Thread):
 			
 			elif not irclib.is_channel(event.target()[0]):
 				# search if the IRC user who sent the message is in one of the bridges
-				for bridge in self.iter_bridges(irc_server=connection.server):
-					try:
-						from_ = bridge.get_participant(source_nickname)
-						# he is, forward the message on XMPP
-						if event.eventtype() == 'action':
-							action = True
-						else:
-							action = False
-						from_.say_on_xmpp_to(connection.nickname, event.arguments()[0], action=action)
-						return
-					except Bridge.NoSuchParticipantException:
-						continue
+				for bridge, from_ in self.get_participants(connection.server, source_nickname):
+					# he is, forward the message on XMPP
+					if event.eventtype() == 'action':
+						action = True
+					else:
+						action = False
+					from_.say_on_xmpp_to(connection.nickname, event.arguments()[0], action=action)
+					return
 				
 				# he isn't, send an error
 				connection.privmsg(source_nickname, 'XIB error: you cannot send a private message to an XMPP user if you are not in one of the chans he is in')
@@ -536,7 +640,7 @@ class Bot(threading.Thread):
 				if connection.nickname == self.nickname:
 					bridge._join_irc_failed(event.eventtype())
 				else:
-					p = bridge.get_participant(connection.nickname)
+					p = bridge.get_participant(connection.nickname, irc=True)
 					p._close_irc_connection(event.eventtype())
 					p.irc_connection = event.eventtype()
 			
@@ -544,7 +648,7 @@ class Bot(threading.Thread):
 				if connection.nickname == self.nickname:
 					bridge.restart(message='Restarting bridge because we received the IRC event '+event.eventtype())
 				else:
-					p = bridge.get_participant(connection.nickname)
+					p = bridge.get_participant(connection.nickname, irc=True)
 					p.irc_connection.join(bridge.irc_room)
 			
 			return
@@ -558,12 +662,7 @@ class Bot(threading.Thread):
 		
 		# Server events
 		if event.eventtype() in ['quit', 'nick']:
-			for bridge in self.iter_bridges(irc_server=connection.server):
-				
-				try:
-					from_ = bridge.get_participant(source_nickname)
-				except Bridge.NoSuchParticipantException:
-					continue
+			for bridge, from_ in self.get_participants(connection.server, source_nickname):
 				
 				handled = True
 				
@@ -603,7 +702,7 @@ class Bot(threading.Thread):
 			from_ = None
 			if source_nickname:
 				try:
-					from_ = bridge.get_participant(source_nickname)
+					from_ = bridge.get_participant(source_nickname, irc=True)
 				except Bridge.NoSuchParticipantException:
 					pass
 			
@@ -617,7 +716,7 @@ class Bot(threading.Thread):
 			# kick handling
 			if event.eventtype() == 'kick':
 				try:
-					kicked = bridge.get_participant(event.arguments()[0])
+					kicked = bridge.get_participant(event.arguments()[0], irc=True)
 				except Bridge.NoSuchParticipantException:
 					self.error(say_levels.debug, 'a participant that was not here has been kicked ? WTF ?'+event_str)
 					return
@@ -634,7 +733,7 @@ class Bot(threading.Thread):
 				if isinstance(kicked.irc_connection, irclib.ServerConnection):
 					# an IRC duplicate of an XMPP user has been kicked, auto-rejoin
 					kicked.irc_connection.join(bridge.irc_room)
-				elif isinstance(kicked.xmpp_c, xmpp.client.Client):
+				elif isinstance(kicked.xmpp_c, xmpp_connection_types):
 					# an IRC user has been kicked, make its duplicate leave
 					kicked.leave(leave_message)
 				else:
@@ -724,13 +823,60 @@ class Bot(threading.Thread):
 				pass
 	
 	
-	def new_bridge(self, xmpp_room, irc_room, irc_server, mode, say_level, irc_port=6667, irc_connection_interval=1, irc_charsets=None):
+	def new_bridge(self, xmpp_room, irc_room, irc_server, mode, say_level, irc_port=6667, irc_connection_interval=1, irc_connect_timeout=None, irc_flood_burst=None, irc_flood_rate=None, irc_charsets=None):
 		"""Create a bridge between xmpp_room and irc_room at irc_server."""
-		b = Bridge(self, xmpp_room, irc_room, irc_server, mode, say_level, irc_port=irc_port, irc_connection_interval=irc_connection_interval, irc_charsets=irc_charsets)
+		b = Bridge(self, xmpp_room, irc_room, irc_server, mode, say_level, irc_port=irc_port, irc_connection_interval=irc_connection_interval, irc_connect_timeout=irc_connect_timeout, irc_flood_burst=irc_flood_burst, irc_flood_rate=irc_flood_rate, irc_charsets=irc_charsets)
 		self.bridges.append(b)
+		self._index_bridge(b)
 		return b
 	
 	
+	def _index_bridge(self, bridge):
+		"""[Internal] Add bridge to the indexes used by iter_bridges."""
+		for index, key in self._bridge_keys(bridge):
+			if not index.has_key(key):
+				index[key] = []
+			index[key].append(bridge)
+	
+	
+	def _unindex_bridge(self, bridge):
+		"""[Internal]"""
+		for index, key in self._bridge_keys(bridge):
+			if bridge in index.get(key, []):
+				index[key].remove(bridge)
+				if len(index[key]) == 0:
+					del index[key]
+	
+	
+	def _bridge_keys(self, bridge):
+		"""[Internal]"""
+		return [(self.bridges_by_irc_room, (bridge.irc_server, bridge.irc_room)), (self.bridges_by_irc_server, bridge.irc_server), (self.bridges_by_xmpp_room_jid, unicode(xmpp.protocol.JID(bridge.xmpp_room_jid)))]
+	
+	
+	def index_participant(self, bridge, participant, keys):
+		"""Add participant of bridge to the nickname directory of the IRC server of bridge, keys are the results of bridge.nickname_key for its nicknames."""
+		self.participants_by_irc_server_lock.acquire()
+		directory = self.participants_by_irc_server.setdefault(bridge.irc_server, {})
+		for key in keys:
+			directory.setdefault(key, []).append((bridge, participant))
+		self.participants_by_irc_server_lock.release()
+	
+	
+	def unindex_participant(self, bridge, participant, keys):
+		"""Remove participant of bridge from the nickname directory of the IRC server of bridge."""
+		self.participants_by_irc_server_lock.acquire()
+		directory = self.participants_by_irc_server.get(bridge.irc_server, {})
+		for key in keys:
+			pairs = directory.get(key, [])
+			if (bridge, participant) in pairs:
+				pairs.remove((bridge, participant))
+				if len(pairs) == 0:
+					del directory[key]
+		if len(directory) == 0 and self.participants_by_irc_server.has_key(bridge.irc_server):
+			del self.participants_by_irc_server[bridge.irc_server]
+		self.participants_by_irc_server_lock.release()
+	
+	
 	def format_message(self, importance, message):
 		if importance < 0 or importance >= len(say_levels.levels):
 			raise Exception('[Internal Error] unknown message importance')
@@ -751,13 +897,20 @@ class Bot(threading.Thread):
 	
 	
 	def iter_bridges(self, irc_room=None, irc_server=None, xmpp_room_jid=None, patterns=None):
-		for bridge in self.bridges:
+		# start from the smallest index matching the arguments
+		if xmpp_room_jid != None:
+			bridges = self.bridges_by_xmpp_room_jid.get(unicode(xmpp.protocol.JID(xmpp_room_jid)), [])
+		elif irc_room != None and irc_server != None:
+			bridges = self.bridges_by_irc_room.get((irc_server, irc_room), [])
+		elif irc_server != None:
+			bridges = self.bridges_by_irc_server.get(irc_server, [])
+		else:
+			bridges = self.bridges
+		for bridge in bridges:
 			if irc_room != None and bridge.irc_room != irc_room:
 				continue
 			if irc_server != None and bridge.irc_server != irc_server:
 				continue
-			if xmpp_room_jid != None and bridge.xmpp_room_jid != xmpp_room_jid:
-				continue
 			if patterns != None:
 				for pattern in patterns:
 					if not pattern in str(bridge):
@@ -765,61 +918,250 @@ class Bot(threading.Thread):
 			yield bridge
 	
 	
+	def get_participants(self, irc_server, nickname):
+		"""Returns a list of (bridge, participant) pairs, one for each bridge on irc_server that has a participant using nickname, see Bridge.get_participant."""
+		self.participants_by_irc_server_lock.acquire()
+		pairs = self.participants_by_irc_server.get(irc_server, {}).get(nickname_key(nickname), [])
+		bridges = []
+		for bridge, participant in pairs:
+			if not bridge in bridges:
+				bridges.append(bridge)
+		self.participants_by_irc_server_lock.release()
+		participants = []
+		for bridge in bridges:
+			try:
+				participants.append((bridge, bridge.get_participant(nickname, irc=True)))
+			except Bridge.NoSuchParticipantException:
+				continue
+		return participants
+	
+	
 	def get_xmpp_connection(self, nickname):
 		if self.xmpp_connections.has_key(nickname):
 			c = self.xmpp_connections[nickname]
 			c.used_by += 1
 			self.error(3, 'using existing XMPP connection for "'+nickname+'", now used by '+str(c.used_by)+' bridges', debug=True)
 			return c
+		if self.component and nickname != self.nickname:
+			self.error(3, 'opening new XMPP component session for "'+nickname+'"', debug=True)
+			c = self.component.open_session(nickname)
+			c.lock.acquire()
+			self.xmpp_connections[nickname] = c
+			c.used_by = 1
+			c.RegisterHandler('presence', self._xmpp_presence_handler)
+			c.RegisterHandler('iq', self._xmpp_iq_handler)
+			c.RegisterHandler('message', self._xmpp_message_handler)
+			c.lock.release()
+			return c
+		if nickname != self.nickname:
+			c = self._xmpp_pool_take()
+			if c:
+				self.error(3, 'using a spare XMPP connection for "'+nickname+'"', debug=True)
+				c.lock.acquire()
+				self.xmpp_connections[nickname] = c
+				c.used_by = 1
+				c.nickname = nickname
+				c.lock.release()
+				return c
 		self.error(3, 'opening new XMPP connection for "'+nickname+'"', debug=True)
-		c = xmpp.client.Client(self.bare_jid.getDomain(), debug=[])
-		c.lock = threading.RLock()
+		c = self._new_xmpp_connection(nickname)
 		c.lock.acquire()
 		self.xmpp_connections[nickname] = c
 		c.used_by = 1
+		self._open_xmpp_connection(c)
+		c.lock.release()
+		return c
+	
+	
+	def _new_xmpp_connection(self, nickname):
+		"""[Internal]"""
+		c = xmpp.client.Client(self.bare_jid.getDomain(), debug=[])
+		c.lock = threading.RLock()
+		c.used_by = 0
 		c.nickname = nickname
 		c.mucs = []
+		c.participants = []
 		c.pings = []
+		c.fd = None
+		c.timers = set()
+		return c
+	
+	
+	def _open_xmpp_connection(self, c):
+		"""[Internal] Connect and authenticate c, then make the XMPP loop process it."""
 		c.connect()
-		c.auth(self.bare_jid.getNode(), self.password)
+		if c.nickname == self.nickname:
+			c.auth(self.bare_jid.getNode(), self.password)
+		else:
+			self._xmpp_duplicate_auth(c)
+		StreamManagement().PlugIn(c)
+		c.StreamManagement.enable()
 		c.RegisterHandler('presence', self._xmpp_presence_handler)
 		c.RegisterHandler('iq', self._xmpp_iq_handler)
 		c.RegisterHandler('message', self._xmpp_message_handler)
-		c.sendInitPresence()
-		if nickname == self.nickname:
+		if c.nickname == self.nickname:
+			# duplicates only need the presences they send to their rooms
+			c.sendInitPresence()
 			c.send(xmpp.protocol.Presence(priority=127))
-		c.lock.release()
+		self._xmpp_watch(c)
+	
+	
+	def _xmpp_pool_loop(self):
+		"""[Internal] Keep xmpp_pool_size spare XMPP connections authenticated."""
+		self.xmpp_pool_condition.acquire()
+		while not self.halt:
+			if len(self.xmpp_pool) >= self.xmpp_pool_size:
+				self.xmpp_pool_condition.wait()
+				continue
+			self.xmpp_pool_condition.release()
+			self.error(3, 'opening a spare XMPP connection', debug=True)
+			c = self._new_xmpp_connection('')
+			c.lock.acquire()
+			try:
+				self._open_xmpp_connection(c)
+			except:
+				self._xmpp_unwatch(c)
+				c.lock.release()
+				c = None
+				self.error(say_levels.warning, 'Failed to open a spare XMPP connection:\n'+traceback.format_exc())
+			else:
+				c.lock.release()
+			self.xmpp_pool_condition.acquire()
+			if c:
+				self.xmpp_pool.append(c)
+			else:
+				# try again later
+				self.xmpp_pool_condition.wait(self.xmpp_ping_interval)
+		self.xmpp_pool_condition.release()
+		self._xmpp_pool_close()
+	
+	
+	def _xmpp_pool_take(self):
+		"""[Internal] Returns a spare XMPP connection or None."""
+		self.xmpp_pool_condition.acquire()
+		c = None
+		if self.xmpp_pool:
+			c = self.xmpp_pool.pop(0)
+			self.xmpp_pool_condition.notify()
+		self.xmpp_pool_condition.release()
 		return c
 	
 	
+	def _xmpp_pool_discard(self, c):
+		"""[Internal] Remove c from the spare XMPP connections, returns False if it was not one of them."""
+		self.xmpp_pool_condition.acquire()
+		pooled = c in self.xmpp_pool
+		if pooled:
+			self.xmpp_pool.remove(c)
+			self.xmpp_pool_condition.notify()
+		self.xmpp_pool_condition.release()
+		if pooled:
+			self._xmpp_unwatch(c)
+		return pooled
+	
+	
+	def _xmpp_pool_close(self):
+		"""[Internal] Close the spare XMPP connections and stop refilling the pool."""
+		self.xmpp_pool_condition.acquire()
+		pool = self.xmpp_pool
+		self.xmpp_pool = []
+		self.xmpp_pool_condition.notify()
+		self.xmpp_pool_condition.release()
+		for c in pool:
+			self._xmpp_unwatch(c)
+			try:
+				c.disconnect()
+			except IOError:
+				pass
+	
+	
+	def _xmpp_duplicate_auth(self, c):
+		"""[Internal] Authenticate the connection of a duplicate and bind a resource.
+		
+		Same as xmpp.client.Client.auth except that the session is only established when the server requires it, it is optional since RFC 6121 and costs a round trip per duplicate."""
+		c._User, c._Password, c._Resource = self.bare_jid.getNode(), self.password, ''
+		while not c.Dispatcher.Stream.features and c.Process(1): pass
+		scram.SASL(c._User, c._Password).PlugIn(c)
+		if c.SASL.startsasl == 'not-supported':
+			return c.auth(c._User, c._Password, sasl=0)
+		c.SASL.auth()
+		while c.SASL.startsasl == 'in-process' and c.Process(1): pass
+		if c.SASL.startsasl != 'success':
+			return None
+		while not c.Dispatcher.Stream.features and c.Process(1): pass
+		features = c.Dispatcher.Stream.features
+		bind = xmpp.protocol.Iq(typ='set', payload=[xmpp.simplexml.Node('bind', attrs={'xmlns': xmpp.protocol.NS_BIND})])
+		response = c.SendAndWaitForResponse(bind)
+		if not xmpp.protocol.isResultNode(response):
+			return None
+		jid = xmpp.protocol.JID(response.getTag('bind').getTagData('jid'))
+		c.User, c.Resource = jid.getNode(), jid.getResource()
+		session = features.getTag('session', namespace=xmpp.protocol.NS_SESSION)
+		if session != None and session.getTag('optional') == None:
+			c.SendAndWaitForResponse(xmpp.protocol.Iq(typ='set', payload=[xmpp.simplexml.Node('session', attrs={'xmlns': xmpp.protocol.NS_SESSION})]))
+		c.connected += '+sasl'
+		return 'sasl'
+	
+	
 	def reopen_xmpp_connection(self, c):
-		if not isinstance(c, xmpp.client.Client):
+		if isinstance(c, ComponentSession) and not self.component.isConnected():
+			# the sessions share the stream of the component, reconnecting it rejoins all their MUCs
+			self.error(3, 'reconnecting XMPP component for "'+c.nickname+'"', debug=True)
+			self.component.lock.acquire()
+			try:
+				self.component.reconnect()
+			finally:
+				self.component.lock.release()
+			return c
+		if not isinstance(c, xmpp_connection_types):
+			return
+		if self._xmpp_pool_discard(c):
+			# a spare connection, the pool will open another one
 			return
+		self._xmpp_unwatch(c)
+		if c.__dict__.has_key('StreamManagement'):
+			try:
+				if c.StreamManagement.resume():
+					self.error(3, 'resumed XMPP session of "'+c.nickname+'"', debug=True)
+					self._xmpp_watch(c)
+					return c
+			except IOError:
+				pass
 		bot_connection = False
 		if c == self.xmpp_c:
 			bot_connection = True
 		mucs = c.mucs
 		nickname = c.nickname
 		used_by = c.used_by
-		participants = []
-		for b in self.bridges:
-			for p in b.participants:
-				if p.xmpp_c == c:
-					participants.append(p)
-					p.xmpp_c = None
+		participants = c.participants
+		c.participants = []
+		for p in participants:
+			p.xmpp_c = None
 		self.error(3, 'reopening XMPP connection for "'+nickname+'"', debug=True)
 		if self.xmpp_connections.has_key(nickname):
 			self.xmpp_connections.pop(nickname)
-		c.send(xmpp.protocol.Presence(typ='unavailable'))
+		self._xmpp_unwatch(c)
+		if isinstance(c, ComponentSession):
+			# only this session is replaced, the MUCs of the others stay joined
+			c.mucs = []
+			self.component.lock.acquire()
+			self.component.close_session(c)
+			self.component.lock.release()
+		else:
+			try:
+				c.send(xmpp.protocol.Presence(typ='unavailable'))
+			except IOError:
+				pass
 		del c
 		c = self.get_xmpp_connection(nickname)
 		c.used_by = used_by
 		if bot_connection:
 			self.xmpp_c = c
 		for p in participants:
-			p.xmpp_c = c
+			p.set_xmpp_connection(c)
 		c.mucs = mucs
 		for m in c.mucs:
+			m.xmpp_c = c
 			m.rejoin()
 		return c
 	
@@ -833,7 +1175,11 @@ class Bot(threading.Thread):
 		if c.used_by < 1 or force:
 			self.error(3, 'closing XMPP connection for "'+nickname+'"', debug=True)
 			self.xmpp_connections.pop(nickname)
-			c.send(xmpp.protocol.Presence(typ='unavailable'))
+			if isinstance(c, ComponentSession):
+				self.component.close_session(c)
+			else:
+				self._xmpp_unwatch(c)
+				c.send(xmpp.protocol.Presence(typ='unavailable'))
 			c.lock.release()
 			del c
 		else:
@@ -843,6 +1189,8 @@ class Bot(threading.Thread):
 	
 	def remove_bridge(self, bridge, message='Removing bridge', log=True):
 		self.bridges.remove(bridge)
+		self._unindex_bridge(bridge)
+		bridge.cancel_restart()
 		bridge.stop(message=message, log=log)
 	
 	
@@ -888,10 +1236,12 @@ class Bot(threading.Thread):
 				bridges_restart += '\n'+str(b)
 				leave_message += ', restart in '+str(delay)+'s'
 				b.reconnecting = True
-				self.irc.execute_delayed(delay, b.init2)
+				b.restart_timer = self.irc.execute_delayed(delay, b.init2)
 			else:
 				bridges_stop_found = True
 				bridges_stop += '\n'+str(b)
+				# a restart armed by a previous failure must not bring the bridge back
+				b.cancel_restart()
 			
 			b.stop(message=leave_message, log=False)
 	
@@ -914,3 +1264,8 @@ class Bot(threading.Thread):
 		for bridge in self.bridges:
 			self.remove_bridge(bridge, message='Stopping bot', log=False)
 		self.halt = True
+		self.xmpp_waker.wake()
+		self.irc.wakeup()
+		self.xmpp_pool_condition.acquire()
+		self.xmpp_pool_condition.notify()
+		self.xmpp_pool_condition.release()
@@ -24,10 +24,20 @@ import muc
 xmpp = muc.xmpp
 del muc
 
+from component import xmpp_connection_types
 from participant import Participant
 import say_levels
 
 
+def nickname_key(nickname):
+	"""Returns the key of nickname in the participants index, IRC nicknames are case insensitive (RFC 1459).
+	
+	Keys are interned, the participants of several bridges using the same nickname share them."""
+	if isinstance(nickname, unicode):
+		nickname = nickname.encode('utf-8')
+	return intern(irclib.irc_lower(nickname))
+
+
 class Bridge:
 	
 	modes = ['bypass', 'normal', 'limited', 'minimal']
@@ -35,22 +45,28 @@ class Bridge:
 	class NoSuchParticipantException(Exception): pass
 	
 	
-	def __init__(self, owner_bot, xmpp_room_jid, irc_room, irc_server, mode, say_level, irc_port=6667, irc_connection_interval=None, irc_charsets=None):
+	def __init__(self, owner_bot, xmpp_room_jid, irc_room, irc_server, mode, say_level, irc_port=6667, irc_connection_interval=None, irc_connect_timeout=None, irc_flood_burst=None, irc_flood_rate=None, irc_charsets=None):
 		"""Create a new bridge."""
 		self.bot = owner_bot
 		self.irc_server = irc_server
 		self.irc_port = irc_port
 		self.irc_room = irc_room.lower()
 		self.irc_connection_interval = irc_connection_interval
+		self.irc_connect_timeout = irc_connect_timeout
+		self.irc_flood_burst = irc_flood_burst
+		self.irc_flood_rate = irc_flood_rate
 		self.irc_charsets = irc_charsets
 		self.irc_op = False
 		self.xmpp_room_jid = xmpp_room_jid
 		self.say_level = say_level
 		self.participants = []
+		self.participants_by_nickname = {}
+		self.participants_keys = {}
 		if mode not in self.__class__.modes:
 			raise Exception('[Error] "'+mode+'" is not a correct value for a bridge\'s "mode" attribute')
 		self.mode = mode
 		self.stopped = False
+		self.restart_timer = None
 		
 		self.lock = threading.RLock()
 		
@@ -58,6 +74,7 @@ class Bridge:
 	
 	
 	def init2(self):
+		self.cancel_restart()
 		self.reconnecting = False
 		
 		self.bot.error(say_levels.notice, 'starting bridge "'+str(self)+'" with mode="'+self.mode+'" and say_level="'+str(self.say_level)+'"')
@@ -67,7 +84,7 @@ class Bridge:
 		self.xmpp_room.join(self.bot.xmpp_c, self.bot.nickname, callback=self._xmpp_join_callback)
 		
 		# Join IRC room
-		self.irc_connection = self.bot.irc.open_connection(self.irc_server, self.irc_port, self.bot.nickname, delay=self.irc_connection_interval)
+		self.irc_connection = self.bot.irc.open_connection(self.irc_server, self.irc_port, self.bot.nickname, delay=self.irc_connection_interval, connect_timeout=self.irc_connect_timeout, flood_burst=self.irc_flood_burst, flood_rate=self.irc_flood_rate)
 		self.irc_connection.connect(nick_callback=self._irc_nick_callback, charsets=self.irc_charsets)
 	
 	
@@ -143,7 +160,7 @@ class Bridge:
 		if (from_protocol == 'irc' and nickname == self.bot.nickname) or (from_protocol == 'xmpp' and nickname == self.bot.nickname):
 			return
 		try:
-			p = self.get_participant(nickname)
+			p = self.get_participant(nickname, irc=(from_protocol == 'irc'))
 			if p.protocol != from_protocol:
 				if from_protocol == 'irc' and isinstance(p.irc_connection, irclib.ServerConnection) and p.irc_connection.channels.has_key(self.irc_room) and p.irc_connection.channels[self.irc_room].state >= irclib.JOINING or from_protocol == 'xmpp' and isinstance(p.muc, xmpp.muc) and p.muc.state >= p.muc.JOINING:
 					return p
@@ -163,6 +180,7 @@ class Bridge:
 			return
 		self.lock.acquire()
 		self.participants.append(p)
+		self._index_participant(p)
 		self.lock.release()
 		if self.mode not in ['normal', 'bypass']:
 			if from_protocol == 'xmpp':
@@ -180,6 +198,13 @@ class Bridge:
 				p.create_duplicate_on_xmpp()
 	
 	
+	def cancel_restart(self):
+		"""Cancel the restart scheduled by Bot.restart_bridges_delayed, if any."""
+		if self.restart_timer:
+			self.restart_timer.cancel()
+			self.restart_timer = None
+	
+	
 	def change_mode(self, new_mode):
 		if new_mode == self.mode:
 			return 'Mode is already equal to '+self.mode
@@ -241,13 +266,22 @@ class Bridge:
 		self.say(say_levels.notice, 'Bridge is switching from '+old_mode+' to '+new_mode+' mode.', log=True)
 	
 	
-	def get_participant(self, nickname):
-		"""Returns a participant object if there is a participant using nickname in the bridge. Raises a NoSuchParticipantException otherwise."""
+	def get_participant(self, nickname, irc=False):
+		"""Returns a participant object if there is a participant using nickname in the bridge. Raises a NoSuchParticipantException otherwise.
+		
+		XMPP nicknames are case sensitive. If irc is True nickname comes from IRC, when no participant uses it exactly it is compared like on IRC (see nickname_key) with the nicknames of the participants on the IRC side."""
+		key = nickname_key(nickname)
 		self.lock.acquire()
-		for p in self.participants:
+		participants = self.participants_by_nickname.get(key, [])
+		for p in participants:
 			if nickname in [p.nickname, p.duplicate_nickname]:
 				self.lock.release()
 				return p
+		if irc:
+			for p in participants:
+				if p.protocol == 'irc' and nickname_key(p.nickname) == key or p.protocol != 'irc' and nickname_key(p.duplicate_nickname) == key:
+					self.lock.release()
+					return p
 		self.lock.release()
 		raise self.NoSuchParticipantException('there is no participant using the nickname "'+nickname+'" in this bridge')
 	
@@ -263,23 +297,53 @@ class Bridge:
 		return participants_nicknames
 	
 	
-	def has_participant(self, nickname):
+	def has_participant(self, nickname, irc=False):
 		try:
-			self.get_participant(nickname)
+			self.get_participant(nickname, irc=irc)
 			return True
 		except self.NoSuchParticipantException:
 			return False
 	
 	
+	def reindex_participant(self, p):
+		"""Update the participants index after p changed nickname or duplicate_nickname. Does nothing if p has not been added to the bridge."""
+		self.lock.acquire()
+		if self.participants_keys.has_key(p):
+			self._unindex_participant(p)
+			self._index_participant(p)
+		self.lock.release()
+	
+	
+	def _index_participant(self, p):
+		"""[Internal] Add p to the participants index under its nickname and duplicate nickname."""
+		keys = set([nickname_key(nickname) for nickname in [p.nickname, p.duplicate_nickname] if nickname])
+		for key in keys:
+			self.participants_by_nickname.setdefault(key, []).append(p)
+		self.participants_keys[p] = keys
+		self.bot.index_participant(self, p, keys)
+	
+	
+	def _unindex_participant(self, p):
+		"""[Internal] Remove p from the participants index."""
+		keys = self.participants_keys.pop(p, [])
+		for key in keys:
+			participants = self.participants_by_nickname[key]
+			participants.remove(p)
+			if not participants:
+				del self.participants_by_nickname[key]
+		self.bot.unindex_participant(self, p, keys)
+	
+	
 	def remove_participant(self, left_protocol, nickname, leave_message):
 		"""Remove the participant using nickname from the bridge. Raises a NoSuchParticipantException if nickname is not used in the bridge."""
 		
 		was_on_both = None
-		p = self.get_participant(nickname)
+		p = self.get_participant(nickname, irc=(left_protocol == 'irc'))
 		
 		if p.left:
 			self.lock.acquire()
 			self.participants.remove(p)
+			self._unindex_participant(p)
 			del p
 			self.lock.release()
 			return
@@ -322,7 +386,7 @@ class Bridge:
 					if isinstance(p.muc, xmpp.muc) and p.muc.state <= p.muc.LEAVING:
 						return
 					# got disconnected somehow
-					if isinstance(p.xmpp_c, xmpp.client.Client):
+					if isinstance(p.xmpp_c, xmpp_connection_types):
 						self.bot.reopen_xmpp_connection(p.xmpp_c)
 					return
 		
@@ -462,7 +526,11 @@ class Bridge:
 		# Delete participants objects
 		for p in self.participants:
 			p.leave(message)
+		self.lock.acquire()
+		for p in self.participants:
+			self._unindex_participant(p)
 		self.participants = []
+		self.lock.release()
 	
 	
 	def __str__(self):
@@ -210,13 +210,14 @@ def irc_connections(bot, command, args_array, bridge):
 	n = len(bot.irc.connections)
 	if args.verbose:
 		ret = 'List of IRC connections ('+str(n)+'):'
+		connections = []
+		for c in bot.irc.connections:
+			queued, throttled_time = c.get_flood_stats()
+			connections.append(str(c)+' (%d lines queued, throttled for %.1f seconds, %d lines decoded by the expected codec, %d failed decodings)' % (queued, throttled_time, c.decode_hits, c.decode_misses))
 		if args.sort:
-			connections = [str(c) for c in bot.irc.connections]
 			connections.sort()
-		else:
-			connections = bot.irc.connections
 		for c in connections:
-			ret += '\n\t'+str(c)
+			ret += '\n\t'+c
 	else:
 		ret = 'Number of IRC connections: '+str(n)
 	return ret
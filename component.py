@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+
+import muc
+xmpp = muc.xmpp
+del muc
+
+
+# characters that must be escaped in the node part of a JID, see XEP-0106
+_node_escapes = [('\\', '\\5c'), (' ', '\\20'), ('"', '\\22'), ('&', '\\26'), ('\'', '\\27'), ('/', '\\2f'), (':', '\\3a'), ('<', '\\3c'), ('>', '\\3e'), ('@', '\\40')]
+
+
+def escape_node(nickname):
+	"""Escape nickname so that it can be used as the node of a JID (XEP-0106)."""
+	for c, e in _node_escapes:
+		nickname = nickname.replace(c, e)
+	return nickname
+
+
+class Component(xmpp.client.Component):
+	"""Connection of the bot to its XMPP server as an external component (XEP-0114).
+
+	The XMPP duplicates of IRC participants are ComponentSession objects multiplexed over this single stream, each one with its own JID in the domain of the component."""
+
+	class AuthenticationFailed(Exception): pass
+
+	def __init__(self, jid, secret, host, port=5347, server=None):
+		"""server is the domain of the XMPP server, by default the parent domain of jid."""
+		xmpp.client.Component.__init__(self, jid, port, debug=[])
+		self.component_jid = jid
+		if server == None:
+			server = jid.split('.', 1)[-1]
+		self.server = server
+		self.secret = secret
+		self.component_host = host
+		self.component_port = port
+		self.sessions = {}
+		self.lock = threading.RLock()
+		self.nickname = jid
+		self.used_by = 1
+		self.mucs = []
+		self.participants = []
+		self.pings = []
+		self.fd = None
+		self.timers = set()
+		self.fn_reconnected = None
+
+
+	def open(self):
+		"""Connect and authenticate to the XMPP server."""
+		if not self.connect(server=(self.component_host, self.component_port)):
+			raise IOError, 'could not connect to '+self.component_host+':'+str(self.component_port)
+		if not self.auth(self.component_jid, self.secret):
+			raise self.AuthenticationFailed, self.component_jid
+		for name in ['presence', 'message', 'iq']:
+			self.RegisterHandler(name, self._dispatch_to_session)
+
+
+	def reconnect(self, exclude=None):
+		"""Reconnect and reauthenticate, then rejoin the MUCs of the sessions except those of exclude."""
+		if not self.reconnectAndReauth():
+			raise IOError, 'could not reconnect component '+self.component_jid
+		if self.fn_reconnected:
+			self.fn_reconnected(self)
+		for session in self.sessions.values():
+			if session != exclude:
+				for m in session.mucs:
+					m.rejoin()
+
+
+	def open_session(self, nickname):
+		"""Returns a new ComponentSession for nickname."""
+		node = escape_node(nickname).lower()
+		while self.sessions.has_key(node):
+			node += '_'
+		session = ComponentSession(self, nickname, node)
+		self.sessions[node] = session
+		return session
+
+
+	def close_session(self, session):
+		"""Forget session, its occupants leave the MUCs it has not left yet.
+		
+		The server does not send unavailable presences for the JIDs of a component, they would stay in the rooms."""
+		for m in session.mucs:
+			if m.state >= m.JOINING:
+				try:
+					session.send(xmpp.protocol.Presence(to=m.jid, typ='unavailable'))
+				except IOError:
+					pass
+				m.state = m.LEFT
+		if self.sessions.get(session.node) == session:
+			self.sessions.pop(session.node)
+
+
+	def _dispatch_to_session(self, dispatcher, stanza):
+		"""[Internal] Pass the stanzas to the sessions they are addressed to."""
+		to = stanza.getTo()
+		if to and to.getNode():
+			session = self.sessions.get(to.getNode().lower())
+			if session:
+				session.dispatch(stanza)
+		elif stanza.getName() == 'iq' and stanza.getType() in ['result', 'error'] and stanza.getID() in self.pings:
+			self.pings.remove(stanza.getID())
+		raise xmpp.protocol.NodeProcessed
+
+
+class ComponentSession:
+	"""An XMPP identity of the bot carried by a Component.
+
+	Provides the part of the xmpp.client.Client interface used by the bot, MUCs and participants, so that it can be used in their place. The handlers are called with the session as dispatcher, like the handlers of a Client are called with its dispatcher whose _owner is the Client."""
+
+	def __init__(self, component, nickname, node):
+		self.component = component
+		self.nickname = nickname
+		self.node = node
+		self.jid = xmpp.protocol.JID(node=node, domain=component.component_jid, resource='xib')
+		self.lock = component.lock
+		self._owner = self
+		self.handlers = {}
+		self.used_by = 0
+		self.mucs = []
+		self.participants = []
+		self.pings = []
+		self.fd = None
+		self.timers = set()
+
+
+	def send(self, stanza):
+		stanza.setFrom(self.jid)
+		return self.component.send(stanza)
+
+
+	def RegisterHandler(self, name, handler, typ='', ns='', xmlns=None, makefirst=0, system=0):
+		if not self.handlers.has_key(name):
+			self.handlers[name] = []
+		if makefirst:
+			self.handlers[name].insert(0, handler)
+		else:
+			self.handlers[name].append(handler)
+
+
+	def UnregisterHandler(self, name, handler, typ='', ns='', xmlns=None):
+		if handler in self.handlers.get(name, []):
+			self.handlers[name].remove(handler)
+
+
+	def dispatch(self, stanza):
+		for handler in self.handlers.get(stanza.getName(), [])[:]:
+			try:
+				handler(self, stanza)
+			except xmpp.protocol.NodeProcessed:
+				return
+
+
+	def reconnectAndReauth(self):
+		self.component.reconnect(exclude=self)
+		return True
+
+
+# classes of the objects that can be used as XMPP connections
+xmpp_connection_types = (xmpp.client.Client, ComponentSession)
@@ -39,8 +39,8 @@ The main features of the IRC client framework are:
   * Messages from an IRC server triggers events, which can be caught
     by event handlers.
   * Reading from and writing to IRC server sockets are normally done
-    by an internal select() loop, but the select()ing may be done by
-    an external main loop.
+    by an internal reactor loop (epoll, poll or select), but the
+    polling may be done by an external main loop.
   * Functions can be registered to execute at specified times by the
     event-loop.
   * Decodes CTCP tagging correctly (hopefully); I haven't seen any
@@ -52,7 +52,7 @@ The main features of the IRC client framework are:
 Current limitations:
 
   * The IRC protocol shines through the abstraction a bit too much.
-  * Data is not written asynchronously to the server, i.e. the write()
+  * Data is not written asynchronously to DCC peers, i.e. the write()
     may block if the TCP buffers are stuffed.
   * There are no support for DCC file transfers.
   * The author haven't even read RFC 2810, 2811, 2812 and 2813.
@@ -62,6 +62,11 @@ Current limitations:
 """
 
 import bisect
+import collections
+import errno
+import fcntl
+import heapq
+import itertools
 import re
 import select
 import socket
@@ -71,7 +76,8 @@ import time
 import types
 import threading
 import traceback
-import math
+import os
+import ssl
 
 import say_levels
 
@@ -84,7 +90,7 @@ DEBUG = 0
 # (maybe) color parser convenience functions
 # documentation (including all event types)
 # (maybe) add awareness of different types of ircds
-# send data asynchronously to the server (and DCC connections)
+# send data asynchronously to DCC connections
 # (maybe) automatically close unused, passive DCC connections after a while
 
 # NOTES
@@ -100,6 +106,315 @@ class IRCError(Exception):
     pass
 
 
+REACTOR_READ = 1
+REACTOR_WRITE = 4
+
+class Reactor:
+    """Base class for the readiness notification backends of IRC objects.
+
+    A reactor keeps track of the file descriptors the IRC object is
+    interested in, so that a wakeup only costs time proportional to
+    the number of ready descriptors instead of the number of open
+    connections.  Each registered descriptor carries an arbitrary data
+    object that is handed back by poll.
+
+    Subclasses must override register, modify, unregister and poll.
+    """
+
+    def __init__(self):
+        self.data = {}
+
+    def __len__(self):
+        return len(self.data)
+
+    def register(self, fd, data, events=REACTOR_READ):
+        """Start watching fd for the given events (REACTOR_READ and/or REACTOR_WRITE)."""
+        raise IRCError, "Not overridden"
+
+    def modify(self, fd, events):
+        """Change the events watched on an already registered fd."""
+        raise IRCError, "Not overridden"
+
+    def unregister(self, fd):
+        """Stop watching fd, does nothing if fd is not registered."""
+        raise IRCError, "Not overridden"
+
+    def poll(self, timeout):
+        """Wait at most timeout seconds for events.
+
+        Returns a list of (data, events) tuples for the ready
+        descriptors.
+        """
+        raise IRCError, "Not overridden"
+
+
+class EpollReactor(Reactor):
+    """Reactor based on Linux's epoll."""
+
+    def __init__(self):
+        Reactor.__init__(self)
+        self.epoll = select.epoll()
+
+    def register(self, fd, data, events=REACTOR_READ):
+        self.data[fd] = data
+        try:
+            self.epoll.register(fd, events)
+        except IOError:
+            self.epoll.modify(fd, events)
+
+    def modify(self, fd, events):
+        self.epoll.modify(fd, events)
+
+    def unregister(self, fd):
+        if self.data.pop(fd, None) is None:
+            return
+        try:
+            self.epoll.unregister(fd)
+        except (IOError, ValueError):
+            # the descriptor was closed before being unregistered
+            pass
+
+    def poll(self, timeout):
+        if timeout is None:
+            timeout = -1
+        try:
+            events = self.epoll.poll(timeout)
+        except IOError, x:
+            if x.errno == errno.EINTR:
+                return []
+            raise
+        return _ready(self.data, events)
+
+
+class PollReactor(Reactor):
+    """Reactor based on poll(2), for systems without epoll."""
+
+    def __init__(self):
+        Reactor.__init__(self)
+        self.poller = select.poll()
+
+    def register(self, fd, data, events=REACTOR_READ):
+        self.data[fd] = data
+        self.poller.register(fd, events)
+
+    def modify(self, fd, events):
+        self.poller.register(fd, events)
+
+    def unregister(self, fd):
+        if self.data.pop(fd, None) is None:
+            return
+        try:
+            self.poller.unregister(fd)
+        except KeyError:
+            pass
+
+    def poll(self, timeout):
+        if timeout is not None:
+            timeout = int(timeout*1000)
+        try:
+            events = self.poller.poll(timeout)
+        except select.error, x:
+            if x.args[0] == errno.EINTR:
+                return []
+            raise
+        return _ready(self.data, events)
+
+
+class SelectReactor(Reactor):
+    """Reactor based on select(2), limited to FD_SETSIZE descriptors."""
+
+    def __init__(self):
+        Reactor.__init__(self)
+        self.events = {}
+
+    def register(self, fd, data, events=REACTOR_READ):
+        self.data[fd] = data
+        self.events[fd] = events
+
+    def modify(self, fd, events):
+        self.events[fd] = events
+
+    def unregister(self, fd):
+        self.data.pop(fd, None)
+        self.events.pop(fd, None)
+
+    def poll(self, timeout):
+        items = self.events.items()
+        r = [fd for fd, e in items if e & REACTOR_READ]
+        w = [fd for fd, e in items if e & REACTOR_WRITE]
+        if not r and not w:
+            if timeout:
+                time.sleep(timeout)
+            return []
+        try:
+            (i, o, e) = select.select(r, w, [], timeout)
+        except select.error, x:
+            if x.args[0] == errno.EINTR:
+                return []
+            raise
+        ready = {}
+        for fd in i:
+            ready[fd] = REACTOR_READ
+        for fd in o:
+            ready[fd] = ready.get(fd, 0) | REACTOR_WRITE
+        return _ready(self.data, ready.iteritems())
+
+
+def _ready(data, events):
+    """[Internal] Maps (fd, events) pairs to (data, events) pairs."""
+    r = []
+    for fd, e in events:
+        d = data.get(fd)
+        if d is not None:
+            r.append((d, e))
+    return r
+
+
+def default_reactor():
+    """Returns a new instance of the best reactor available on this system."""
+    if hasattr(select, 'epoll'):
+        return EpollReactor()
+    elif hasattr(select, 'poll'):
+        return PollReactor()
+    return SelectReactor()
+
+
+class Waker:
+    """Self-pipe used to wake up a thread waiting on a reactor.
+
+    Register the object in the reactor with itself as data, call wake
+    from other threads and clear when the reactor returns it.
+    """
+
+    def __init__(self):
+        self.r, self.w = os.pipe()
+        for fd in (self.r, self.w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def fileno(self):
+        return self.r
+
+    def wake(self):
+        """Make the reactor return."""
+        try:
+            os.write(self.w, 'w')
+        except OSError:
+            # the pipe is full, the reactor will wake up anyway
+            pass
+
+    def clear(self):
+        """Empty the pipe."""
+        try:
+            while os.read(self.r, 512):
+                pass
+        except OSError:
+            pass
+
+
+class Timer:
+    """A function call scheduled by IRC.execute_at or IRC.execute_delayed.
+
+    Call the cancel method to prevent the function from being called.
+    """
+
+    def __init__(self, queue, at, function, arguments, owner):
+        self.queue = queue
+        self.at = at
+        self.function = function
+        self.arguments = arguments
+        self.owner = owner
+        self.cancelled = False
+
+    def cancel(self):
+        """Cancel the call, does nothing if it already happened."""
+        self.queue.cancel(self)
+
+
+class TimerQueue:
+    """Thread-safe heap of Timer objects.
+
+    Cancelled timers are left in the heap and skipped when they come
+    up, the heap is compacted when they outnumber the pending ones.
+
+    A timer can have an owner, which must have a timers attribute (a
+    set) in which the timer is kept until it is called or cancelled,
+    see Connection.cancel_timers.
+
+    If a Waker is given it is woken up when a timer becomes the first
+    one, so that the thread running the timers can wait for the next
+    one without polling.
+    """
+
+    def __init__(self, waker=None):
+        self.heap = []
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        self.pending = 0
+        self.waker = waker
+
+    def __len__(self):
+        return self.pending
+
+    def add(self, at, function, arguments=(), owner=None):
+        """Schedule a call to function at time at, returns a Timer."""
+        timer = Timer(self, at, function, arguments, owner)
+        self.lock.acquire()
+        heapq.heappush(self.heap, (at, self.counter.next(), timer))
+        self.pending += 1
+        if owner is not None:
+            owner.timers.add(timer)
+        first = self.heap[0][2] is timer
+        self.lock.release()
+        if first and self.waker:
+            self.waker.wake()
+        return timer
+
+    def cancel(self, timer):
+        self.lock.acquire()
+        if not timer.cancelled:
+            timer.cancelled = True
+            self._forget(timer)
+            if len(self.heap) > 2*self.pending + 64:
+                self.heap = [x for x in self.heap if not x[2].cancelled]
+                heapq.heapify(self.heap)
+        self.lock.release()
+
+    def next_time(self):
+        """Returns the time of the next pending call, or None."""
+        self.lock.acquire()
+        self._skip_cancelled()
+        if self.heap:
+            at = self.heap[0][0]
+        else:
+            at = None
+        self.lock.release()
+        return at
+
+    def pop(self, now):
+        """Remove and return the first timer due at time now, or None."""
+        self.lock.acquire()
+        self._skip_cancelled()
+        timer = None
+        if self.heap and self.heap[0][0] <= now:
+            timer = heapq.heappop(self.heap)[2]
+            timer.cancelled = True
+            self._forget(timer)
+        self.lock.release()
+        return timer
+
+    def _forget(self, timer):
+        """[Internal] Must be called with the lock held."""
+        self.pending -= 1
+        if timer.owner is not None:
+            timer.owner.timers.discard(timer)
+
+    def _skip_cancelled(self):
+        """[Internal] Must be called with the lock held."""
+        heap = self.heap
+        while heap and heap[0][2].cancelled:
+            heapq.heappop(heap)
+
+
 class IRC:
     """Class that handles one or several IRC server connections.
 
@@ -107,7 +422,7 @@ class IRC:
     Connection objects that represent the IRC connections.  The
     responsibility of the IRC object is to provide an event-driven
     framework for the connections and to keep the connections alive.
-    It runs a select loop to poll each connection's TCP socket and
+    It runs a reactor loop to poll each connection's TCP socket and
     hands over the sockets with incoming data for processing by the
     corresponding connection.
 
@@ -130,11 +445,12 @@ class IRC:
 
     def __init__(self, fn_to_add_socket=None,
                  fn_to_remove_socket=None,
-                 fn_to_add_timeout=None):
+                 fn_to_add_timeout=None,
+                 reactor=None):
         """Constructor for IRC objects.
 
-        Optional arguments are fn_to_add_socket, fn_to_remove_socket
-        and fn_to_add_timeout.  The first two specify functions that
+        Optional arguments are fn_to_add_socket, fn_to_remove_socket,
+        fn_to_add_timeout and reactor.  The first two specify functions that
         will be called with a socket object as argument when the IRC
         object wants to be notified (or stop being notified) of data
         coming on a new socket.  When new data arrives, the method
@@ -152,6 +468,15 @@ class IRC:
 
         An alternative is to just call ServerConnection.process_once()
         once in a while.
+
+        The reactor argument is the Reactor instance used by
+        process_once to wait for data, by default the best one
+        available on the system is used (see default_reactor).
+
+        Data sent to servers is buffered and written when the sockets
+        are writable.  When the buffer of a connection grows over
+        send_buffer_high_water bytes, fn_send_buffer_full (if set) is
+        called with the connection and the size of its buffer.
         """
 
         if fn_to_add_socket and fn_to_remove_socket:
@@ -162,12 +487,26 @@ class IRC:
             self.fn_to_remove_socket = None
 
         self.fn_to_add_timeout = fn_to_add_timeout
+        if reactor is None:
+            reactor = default_reactor()
+        self.reactor = reactor
+        self.waker = Waker()
+        self.reactor.register(self.waker.fileno(), self.waker)
+        self.send_buffer_high_water = 2**16
+        self.fn_send_buffer_full = None
         self.connections = []
+        self.connections_by_nickname = {}
+        self.connections_keys = {}
         self.handlers = {}
-        self.delayed_commands = [] # list of tuples in the format (time, function, arguments)
+        self.dispatch_table = {}
+        self.all_events_handlers = ()
+        self.timers = TimerQueue(self.waker)
         self.charsets = {'': ['utf-8']}
         self.connection_intervals = {'': 1}
+        self.connect_timeouts = {'': 30}
+        self.flood_controls = {'': (5, 0.5)}
         self.connection_stacks = {}
+        self.links = {}
 
         self.add_global_handler("ping", _ping_ponger, -42)
 
@@ -194,9 +533,43 @@ class IRC:
             return self.connection_intervals['']
 
 
+    def flood_control(self, server='', burst=None, rate=None):
+        """Get or set the flood control parameters of connections to server.
+
+        burst is the number of lines that can be sent at once, rate is
+        the number of lines per second that can be sent after that.
+        Returns a (burst, rate) tuple.
+        """
+        if burst or rate:
+            default = self.flood_control(server)
+            self.flood_controls[server] = (burst or default[0], rate or default[1])
+            return self.flood_controls[server]
+        elif self.flood_controls.has_key(server):
+            return self.flood_controls[server]
+        else:
+            return self.flood_controls['']
+
+
+    def connect_timeout(self, server='', seconds=None):
+        """Get or set the number of seconds after which a pending connection to server is abandoned."""
+        if seconds:
+            self.connect_timeouts[server] = seconds
+            return seconds
+        elif self.connect_timeouts.has_key(server):
+            return self.connect_timeouts[server]
+        else:
+            return self.connect_timeouts['']
+
+
     def get_connection(self, server, port, nickname):
-        for c in self.connections:
-            if c.server == server and c.port == port and nickname in [c.nickname, c.real_nickname]:
+        """Returns the ServerConnection object using nickname at server:port, or None.
+
+        Nicknames must match exactly, the index only groups them case
+        insensitively (RFC 1459): a connection of "Bob" is not one of
+        "bob".
+        """
+        for c in self.connections_by_nickname.get(_connection_key(server, port, nickname), []):
+            if nickname in [c.nickname, getattr(c, "real_nickname", None)]:
                 return c
         return None
 
@@ -205,27 +578,98 @@ class IRC:
             return True
         return False
 
-    def open_connection(self, server, port, nickname, delay=None):
+    def open_connection(self, server, port, nickname, delay=None, connect_timeout=None, flood_burst=None, flood_rate=None):
         """Creates or returns an existing ServerConnection object for nickname at server:port.
 
             server -- Server name.
 
             port -- Port number.
 
-            nickname -- The nickname."""
+            nickname -- The nickname.
+
+            delay -- Seconds to wait between two connections to server:port.
+
+            connect_timeout -- Seconds after which a connection attempt to server:port fails.
+
+            flood_burst, flood_rate -- Flood control parameters, see flood_control."""
 
         c = self.get_connection(server, port, nickname)
         if c:
             return c
         c = ServerConnection(self, server, port, nickname)
         server_str = c._server_str()
+        if connect_timeout:
+            self.connect_timeout(server=server_str, seconds=connect_timeout)
+        if flood_burst or flood_rate:
+            self.flood_control(server=server_str, burst=flood_burst, rate=flood_rate)
         if not self.connection_stacks.has_key(server_str):
             self.connection_stacks[server_str] = []
             delay = self.connection_interval(server=server_str, seconds=delay)
             self.execute_delayed(delay, self._connection_loop, (server_str,))
-        self.connections.append(c)
+        self._add_connection(c)
         return c
 
+    def _add_connection(self, connection):
+        """[Internal] Add connection to self.connections and to the index used by get_connection."""
+        self.connections.append(connection)
+        self._index_connection(connection)
+
+    def _index_connection(self, connection):
+        """[Internal]"""
+        keys = set()
+        for nickname in [connection.nickname, getattr(connection, "real_nickname", None)]:
+            if nickname:
+                keys.add(_connection_key(connection.server, connection.port, nickname))
+        for key in keys:
+            self.connections_by_nickname.setdefault(key, []).append(connection)
+        self.connections_keys[connection] = keys
+
+    def _unindex_connection(self, connection):
+        """[Internal]"""
+        for key in self.connections_keys.pop(connection, []):
+            connections = self.connections_by_nickname[key]
+            connections.remove(connection)
+            if not connections:
+                del self.connections_by_nickname[key]
+
+    def _reindex_connection(self, connection):
+        """[Internal] Update the index used by get_connection after the real nickname of connection changed."""
+        if self.connections_keys.has_key(connection):
+            self._unindex_connection(connection)
+            self._index_connection(connection)
+
+    def open_link(self, server, port, name, sid, password, link_server=None, link_port=None, description="xib"):
+        """Creates or returns the ServerLink object to the network of server:port.
+
+            server, port -- The server used by the client connections
+            to the network.
+
+            name, sid -- The name and the TS6 identifier of the server
+            introduced by the link, the hub must have a link block for
+            them.
+
+            password -- The password of the link block.
+
+            link_server, link_port -- The hub accepting the link, by
+            default server:port.
+
+        Once a link is opened the PseudoClient objects returned by its
+        open_client method can be used instead of opening one
+        ServerConnection per nickname."""
+
+        server_str = server+':'+str(port)
+        if self.links.has_key(server_str):
+            return self.links[server_str]
+        link = ServerLink(self, link_server or server, link_port or port, name, sid, password, description)
+        link.network = (server, port)
+        self.links[server_str] = link
+        self._add_connection(link)
+        return link
+
+    def get_link(self, server, port):
+        """Returns the ServerLink object to the network of server:port, or None."""
+        return self.links.get(server+':'+str(port))
+
     def process_data(self, sockets):
         """Called when there is more data to read on connection sockets.
 
@@ -236,12 +680,28 @@ class IRC:
         See documentation for IRC.__init__.
         """
         for s in sockets:
-            for c in self.connections:
-                if s == c._get_socket():
-                    c.lock.acquire()
-                    if hasattr(c, 'socket'):
-                        c.process_data()
-                    c.lock.release()
+            c = self.get_connection_by_socket(s)
+            if c:
+                self._process_connection(c)
+
+    def _process_connection(self, c, events=REACTOR_READ):
+        """[Internal]"""
+        c.lock.acquire()
+        if c.connecting:
+            c._process_connect()
+        else:
+            if events & REACTOR_WRITE:
+                c.flush()
+            if events & ~REACTOR_WRITE and hasattr(c, 'socket'):
+                c.process_data()
+        c.lock.release()
+
+    def get_connection_by_socket(self, s):
+        """Returns the connection using socket s, or None."""
+        try:
+            return self.reactor.data.get(s.fileno())
+        except socket.error:
+            return None
 
     def process_timeout(self):
         """Called when a timeout notification is due.
@@ -249,49 +709,54 @@ class IRC:
         See documentation for IRC.__init__.
         """
         t = time.time()
-        while self.delayed_commands:
-            if t >= self.delayed_commands[0][0]:
-                self.delayed_commands[0][1](*self.delayed_commands[0][2])
-                del self.delayed_commands[0]
-            else:
-                break
+        timer = self.timers.pop(t)
+        while timer:
+            timer.function(*timer.arguments)
+            timer = self.timers.pop(t)
 
     def process_once(self, timeout=0):
         """Process data from connections once.
 
         Arguments:
 
-            timeout -- How long the select() call should wait if no
-                       data is available.
+            timeout -- How long the reactor should wait if no data is
+                       available.
 
         This method should be called periodically to check and process
         incoming data, if there are any.  If that seems boring, look
         at the process_forever method.
         """
-        sockets = map(lambda x: x._get_socket(), self.connections)
-        sockets = filter(lambda x: x and not isinstance(x, basestring), sockets)
-        if sockets:
-            (i, o, e) = select.select(sockets, [], [], timeout)
-            self.process_data(i)
-        else:
-            time.sleep(timeout)
+        for c, e in self.reactor.poll(timeout):
+            if c is self.waker:
+                c.clear()
+            else:
+                self._process_connection(c, e)
         self.process_timeout()
 
-    def process_forever(self, timeout=0.2):
+    def process_forever(self, timeout=None):
         """Run an infinite loop, processing data from connections.
 
-        This method repeatedly calls process_once.
+        This method repeatedly calls process_once, waiting until the
+        next timer is due.  Call wakeup to make it notice a change of
+        bot.halt.
 
         Arguments:
 
-            timeout -- Parameter to pass to process_once.
+            timeout -- Maximum time to wait in process_once, None means
+                       no limit.
         """
         while 1:
             if self.bot.halt:
                 self.disconnect_all(message='Stopping bot')
                 break
+            wait = timeout
+            next_time = self.timers.next_time()
+            if next_time is not None:
+                wait = max(0, next_time - time.time())
+                if timeout is not None:
+                    wait = min(wait, timeout)
             try:
-                self.process_once(timeout)
+                self.process_once(wait)
             except ServerNotConnectedError as e:
                 if len(e.args) > 0:
                     c = e.args[0]
@@ -335,6 +800,7 @@ class IRC:
         if not event in self.handlers:
             self.handlers[event] = []
         bisect.insort(self.handlers[event], ((priority, handler)))
+        self._build_dispatch_table()
 
     def remove_global_handler(self, event, handler):
         """Removes a global handler function.
@@ -352,9 +818,24 @@ class IRC:
         for h in self.handlers[event]:
             if handler == h[1]:
                 self.handlers[event].remove(h)
+        self._build_dispatch_table()
         return 1
 
-    def execute_at(self, at, function, arguments=()):
+    def _build_dispatch_table(self):
+        """[Internal] Compile the handlers into one tuple of functions per event type.
+
+        The "all_events" handlers come first, then the handlers of the
+        event type, both in priority order.  _handle_event uses
+        all_events_handlers for the event types that have no handler.
+        """
+        self.all_events_handlers = tuple([h[1] for h in self.handlers.get("all_events", [])])
+        dispatch_table = {}
+        for event, handlers in self.handlers.iteritems():
+            if event != "all_events":
+                dispatch_table[event] = self.all_events_handlers + tuple([h[1] for h in handlers])
+        self.dispatch_table = dispatch_table
+
+    def execute_at(self, at, function, arguments=(), owner=None):
         """Execute a function at a specified time.
 
         Arguments:
@@ -364,10 +845,14 @@ class IRC:
             function -- Function to call.
 
             arguments -- Arguments to give the function.
+
+            owner -- Object owning the call (see TimerQueue).
+
+        Returns a Timer object that can be used to cancel the call.
         """
-        self.execute_delayed(at-time.time(), function, arguments)
+        return self.execute_delayed(at-time.time(), function, arguments, owner=owner)
 
-    def execute_delayed(self, delay, function, arguments=()):
+    def execute_delayed(self, delay, function, arguments=(), owner=None):
         """Execute a function after a specified time.
 
         Arguments:
@@ -377,10 +862,25 @@ class IRC:
             function -- Function to call.
 
             arguments -- Arguments to give the function.
+
+            owner -- Object owning the call (see TimerQueue).
+
+        Returns a Timer object that can be used to cancel the call.
+
+        This method can be called from any thread.
         """
-        bisect.insort(self.delayed_commands, (delay+time.time(), function, arguments))
+        timer = self.timers.add(delay+time.time(), function, arguments, owner=owner)
         if self.fn_to_add_timeout:
             self.fn_to_add_timeout(delay)
+        return timer
+
+    def wakeup(self):
+        """Interrupt the wait of process_once, can be called from any thread."""
+        self.waker.wake()
+
+    def pending_timers(self):
+        """Returns the number of calls waiting to be executed."""
+        return len(self.timers)
 
     def dcc(self, dcctype="chat"):
         """Creates and returns a DCCConnection object.
@@ -398,18 +898,45 @@ class IRC:
 
     def _handle_event(self, connection, event):
         """[Internal]"""
-        h = self.handlers
-        for handler in h.get("all_events", []) + h.get(event.eventtype(), []):
-            if handler[1](connection, event) == "NO MORE":
+        for handler in self.dispatch_table.get(event.eventtype(), self.all_events_handlers):
+            if handler(connection, event) == "NO MORE":
                 return
 
     def _remove_connection(self, connection):
         """[Internal]"""
         if connection in self.connections:
             self.connections.remove(connection)
+        self._unindex_connection(connection)
+        self._unregister_socket(connection)
         if self.fn_to_remove_socket:
             self.fn_to_remove_socket(connection._get_socket())
 
+    def _register_socket(self, connection, events=REACTOR_READ):
+        """[Internal] Make the reactor watch the socket of connection.
+
+        The reactor also serves as the socket to connection map used to
+        dispatch incoming data.
+        """
+        self._unregister_socket(connection)
+        connection._fd = connection._get_socket().fileno()
+        self.reactor.register(connection._fd, connection, events)
+        # the registration may come from another thread
+        self.waker.wake()
+
+    def _modify_socket(self, connection, events):
+        """[Internal]"""
+        if connection._fd is not None:
+            self.reactor.modify(connection._fd, events)
+            self.waker.wake()
+
+    def _unregister_socket(self, connection):
+        """[Internal]"""
+        fd = connection._fd
+        if fd is not None:
+            if self.reactor.data.get(fd) is connection:
+                self.reactor.unregister(fd)
+            connection._fd = None
+
 
 class UnknownChannel(IRCError): pass
 
@@ -464,6 +991,31 @@ class Channel:
 
 _rfc_1459_command_regexp = re.compile("^(:(?P<prefix>[^ ]+) +)?(?P<command>[^ ]+)( *(?P<argument> .+))?")
 
+def _split_message(line):
+    """[Internal] Split an IRC line into prefix, command and argument.
+
+    Returns the same groups as _rfc_1459_command_regexp, the regexp is
+    only used for the unusual lines (empty prefix or command, trailing
+    spaces) in which the simple splitting would differ from it.
+    """
+    prefix = None
+    rest = line
+    if line[:1] == ':':
+        i = line.find(' ')
+        if i > 1:
+            prefix = line[1:i]
+            rest = line[i+1:].lstrip(' ')
+    i = rest.find(' ')
+    if i < 0:
+        if rest:
+            return prefix, rest, None
+    elif i > 0:
+        argument = rest[i+1:].lstrip(' ')
+        if argument:
+            return prefix, rest[:i], ' ' + argument
+    m = _rfc_1459_command_regexp.match(line)
+    return m.group("prefix"), m.group("command"), m.group("argument")
+
 class Connection:
     """Base class for IRC connections.
 
@@ -471,6 +1023,9 @@ class Connection:
     """
     def __init__(self, irclibobj):
         self.irclibobj = irclibobj
+        self._fd = None
+        self.timers = set()
+        self.connecting = False
 
     def _get_socket():
         raise IRCError, "Not overridden"
@@ -479,10 +1034,15 @@ class Connection:
     ### Convenience wrappers.
 
     def execute_at(self, at, function, arguments=()):
-        self.irclibobj.execute_at(at, function, arguments)
+        return self.irclibobj.execute_at(at, function, arguments, owner=self)
 
     def execute_delayed(self, delay, function, arguments=()):
-        self.irclibobj.execute_delayed(delay, function, arguments)
+        return self.irclibobj.execute_delayed(delay, function, arguments, owner=self)
+
+    def cancel_timers(self):
+        """Cancel all the calls scheduled through this connection."""
+        for timer in list(self.timers):
+            timer.cancel()
 
 
 class ServerConnectionError(IRCError):
@@ -496,6 +1056,58 @@ class ServerNotConnectedError(ServerConnectionError):
 # use \n as message separator!  :P
 _linesep_regexp = re.compile("\r?\n")
 
+# Priorities of the lines delayed by flood control, lower is sent first,
+# the other commands have the lowest priority.
+_flood_priorities = {'PONG': 0, 'PING': 0, 'PASS': 0, 'NICK': 0, 'USER': 0,
+                     'JOIN': 1, 'PART': 1, 'MODE': 1}
+_flood_priority_levels = 3
+# Commands that are sent without waiting, QUIT is sent just before
+# closing the connection.
+_flood_exempt_commands = frozenset(['QUIT'])
+
+_ascii_compatible_codecs = {}
+
+def _ascii_compatible(codec):
+    """[Internal] Returns True if codec decodes ASCII bytes like ASCII does."""
+    if not _ascii_compatible_codecs.has_key(codec):
+        try:
+            compatible = ''.join([chr(i) for i in range(128)]).decode(codec) == u''.join([unichr(i) for i in range(128)])
+        except (LookupError, UnicodeDecodeError):
+            compatible = False
+        _ascii_compatible_codecs[codec] = compatible
+    return _ascii_compatible_codecs[codec]
+
+def _split_utf8(bytes, size):
+    """[Internal] Split UTF-8 encoded bytes in chunks of at most size bytes.
+
+    The chunks are cut on the last space if it is in their second
+    half (the space is dropped), otherwise on the last character
+    boundary.
+    """
+    size = max(size, 4)
+    chunks = []
+    start = 0
+    length = len(bytes)
+    while length - start > size:
+        end = start + size
+        space = bytes.rfind(' ', start + size/2, end + 1)
+        if space >= 0:
+            chunks.append(bytes[start:space])
+            start = space + 1
+            continue
+        # continuation bytes of UTF-8 characters are 10xxxxxx
+        while ord(bytes[end]) & 0xC0 == 0x80:
+            end -= 1
+        chunks.append(bytes[start:end])
+        start = end
+    if start < length:
+        chunks.append(bytes[start:])
+    return chunks
+
+# Events that are passed to the nick callbacks of a ServerConnection.
+_nick_callback_events = frozenset(['disconnect', 'nicknameinuse', 'nickcollision', 'erroneusnickname', 'nicknametoolong'])
+
+
 class ServerConnection(Connection):
     """This class represents an IRC server connection.
 
@@ -522,6 +1134,26 @@ class ServerConnection(Connection):
         self.handlers = {}
         self.real_server_name = ""
         self.new_nickname = None
+        self.ping_timer = None
+        self.connect_timer = None
+        self.send_lock = threading.Lock()
+        self.send_queue = collections.deque()
+        self.send_buffer_size = 0
+        self.send_buffer_full = False
+        self.send_retry = False
+        self.writing = False
+        self.bytes_queued = 0
+        self.bytes_sent = 0
+        self.flood_queues = [collections.deque() for i in range(_flood_priority_levels)]
+        self.flood_queued = 0
+        self.flood_tokens = 0
+        self.flood_last_refill = 0
+        self.flood_timer = None
+        self.throttled_since = None
+        self.throttled_time = 0
+        self.nick_codecs = {}
+        self.decode_hits = 0
+        self.decode_misses = 0
 
 
     def __str__(self):
@@ -529,17 +1161,61 @@ class ServerConnection(Connection):
 
 
     def _decode(self, bytes):
+        """[Internal] Decode a line received from the server.
+
+        The first configured charset is always tried first.  For the
+        lines it cannot decode, the codec that last decoded a line of
+        the same sender is tried before the other charsets, a sender is
+        expected to keep using the same charset.  Pure ASCII lines are
+        decoded without looking at the charsets.  decode_hits counts
+        the lines decoded by the first charset or by the codec of their
+        sender, decode_misses the failed tries.
+        """
         charsets = self.irclibobj.charsets[self._server_str()] or self.irclibobj.charsets['']
-        for codec in charsets:
+        if _ascii_compatible(charsets[0]):
             try:
-                return bytes.decode(codec)
-            except (UnicodeEncodeError, UnicodeDecodeError):
+                line = bytes.decode('ascii')
+                self.decode_hits += 1
+                return line
+            except UnicodeDecodeError:
                 pass
+
+        # the fallbacks never fail on latin-1 family charsets, they must not hide the lines in the first charset
+        try:
+            line = bytes.decode(charsets[0])
+            self.decode_hits += 1
+            return line
+        except (UnicodeEncodeError, UnicodeDecodeError):
+            self.decode_misses += 1
+
+        nick = _sender_nick(bytes)
+        preferred = self.nick_codecs.get(nick)
+        if preferred in charsets[1:]:
+            try:
+                line = bytes.decode(preferred)
+                self.decode_hits += 1
+                return line
+            except (UnicodeEncodeError, UnicodeDecodeError):
+                self.decode_misses += 1
+
+        for codec in charsets[1:]:
+            if codec == preferred:
+                continue
+            try:
+                line = bytes.decode(codec)
+            except (UnicodeEncodeError, UnicodeDecodeError):
+                self.decode_misses += 1
+                continue
+            if nick:
+                if len(self.nick_codecs) > 4096:
+                    self.nick_codecs.clear()
+                self.nick_codecs[nick] = codec
+            return line
         raise Exception, 'no suitable codec found for: '+repr(bytes)+'\ntried: '+' '.join(charsets)
 
 
     def _ping(self):
-        self.irclibobj.execute_delayed(60, self._ping)
+        self.ping_timer = self.execute_delayed(60, self._ping)
         if self.connected == False:
             return
         self.irclibobj.bot.error(1, 'sending IRC ping', debug=True)
@@ -593,6 +1269,7 @@ class ServerConnection(Connection):
             if charsets or not self.irclibobj.charsets.has_key(self._server_str()):
                 self.irclibobj.charsets[self._server_str()] = charsets
             self.real_nickname = self.nickname
+            self.irclibobj._reindex_connection(self)
             self.username = username or self.nickname
             self.ircname = ircname or self.nickname
             self.password = password
@@ -610,6 +1287,8 @@ class ServerConnection(Connection):
 
     def _connect(self):
         
+        if self.ping_timer:
+            self.ping_timer.cancel()
         self._ping()
 
         self.lock.acquire()
@@ -623,16 +1302,110 @@ class ServerConnection(Connection):
             self.socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
         else:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setblocking(0)
         try:
             self.socket.bind((self.localaddress, self.localport))
-            self.socket.connect((self.server, self.port))
-            if self.ssl:
-                self.ssl = socket.ssl(self.socket)
+            error = self.socket.connect_ex((self.server, self.port))
         except socket.error, x:
+            error = x
+        if error in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+            # The reactor will tell us when the connection is established.
+            self.connecting = 'tcp'
+            self.irclibobj._register_socket(self, REACTOR_WRITE)
+            self.connect_timer = self.execute_delayed(self.irclibobj.connect_timeout(server=self._server_str()), self._connect_timeout)
+        elif error:
+            if isinstance(error, int):
+                error = os.strerror(error)
+            self._connect_failed(error)
+        else:
+            self.irclibobj._register_socket(self, REACTOR_WRITE)
+            self._connected()
+
+        self.lock.release()
+        return self
+
+
+    def _process_connect(self):
+        """[Internal] Called by the reactor while the connection is being established."""
+        if self.connecting == 'tcp':
+            error = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                self._connect_failed(os.strerror(error))
+            else:
+                self._connected()
+        elif self.connecting == 'ssl':
+            self._ssl_handshake()
+
+
+    def _connected(self):
+        """[Internal] The TCP connection is established."""
+        if self.ssl:
+            self.connecting = 'ssl'
+            try:
+                self.ssl = ssl.wrap_socket(self.socket, do_handshake_on_connect=False)
+            except ssl.SSLError, x:
+                self._connect_failed(x)
+                return
+            self._ssl_handshake()
+        else:
+            self._logon()
+
+
+    def _ssl_handshake(self):
+        """[Internal]"""
+        try:
+            self.ssl.do_handshake()
+        except ssl.SSLError, x:
+            if x.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self.irclibobj._modify_socket(self, REACTOR_READ)
+            elif x.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self.irclibobj._modify_socket(self, REACTOR_WRITE)
+            else:
+                self._connect_failed(x)
+            return
+        except socket.error, x:
+            self._connect_failed(x)
+            return
+        self._logon()
+
+
+    def _connect_timeout(self):
+        """[Internal]"""
+        self.lock.acquire()
+        if self.connecting:
+            self._connect_failed('timed out')
+        self.lock.release()
+
+
+    def _connect_failed(self, reason):
+        """[Internal] Give up on the connection, the nick callbacks receive a disconnect error."""
+        if self.connect_timer:
+            self.connect_timer.cancel()
+            self.connect_timer = None
+        self.connecting = False
+        self.irclibobj._unregister_socket(self)
+        try:
             self.socket.close()
-            self.socket = 'closed'
-            raise ServerConnectionError, "Couldn't connect to socket: %s" % x
+        except socket.error, x:
+            pass
+        self.socket = 'closed'
+        self._handle_event(Event("disconnect", self.server, "", ["Couldn't connect to socket: %s" % reason]))
+
+
+    def _logon(self):
+        """[Internal] The connection is ready, register on the server."""
+        if self.connect_timer:
+            self.connect_timer.cancel()
+            self.connect_timer = None
+        self.connecting = False
         self.connected = True
+        self.send_queue = collections.deque()
+        self.send_buffer_size = 0
+        self.send_buffer_full = False
+        self.send_retry = False
+        self.writing = False
+        self._reset_flood_control()
+        self.irclibobj._modify_socket(self, REACTOR_READ)
         if self.irclibobj.fn_to_add_socket:
             self.irclibobj.fn_to_add_socket(self.socket)
 
@@ -646,9 +1419,6 @@ class ServerConnection(Connection):
         if len(self.channels) > 0:
             for channel in self.channels.itervalues():
                 channel.rejoin()
-        
-        self.lock.release()
-        return self
 
 
     def _call_nick_callbacks(self, error, arguments=[]):
@@ -680,6 +1450,7 @@ class ServerConnection(Connection):
         been called, the object is unusable.
         """
 
+        self.cancel_timers()
         self.irclibobj._remove_connection(self)
         self.disconnect(message=message, volontary=volontary)
 
@@ -699,69 +1470,97 @@ class ServerConnection(Connection):
         else:
             return ""
 
-    def process_data(self):
-        """[Internal]"""
+    def _receive(self):
+        """[Internal] Read the socket, returns the complete lines received or None."""
 
         try:
             if self.ssl:
                 new_data = self.ssl.read(2**14)
+                while self.ssl.pending():
+                    new_data += self.ssl.read(2**14)
             elif self.socket and hasattr(self.socket, 'recv'):
                 new_data = self.socket.recv(2**14)
             else:
-                return
+                return None
+        except ssl.SSLError, x:
+            if x.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                return None
+            self.disconnect("Connection reset by peer")
+            return None
         except socket.error, x:
+            if x.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return None
             # The server hung up.
             self.disconnect("Connection reset by peer")
-            return
+            return None
         if not new_data:
             # Read nothing: connection must be down.
             self.disconnect("Connection reset by peer")
-            return
+            return None
 
-        lines = _linesep_regexp.split(self.previous_buffer + new_data)
+        lines = (self.previous_buffer + new_data).split("\n")
 
         # Save the last, unfinished line.
         self.previous_buffer = lines.pop()
 
+        return lines
+
+    def process_data(self):
+        """[Internal]"""
+
+        lines = self._receive()
+        if not lines:
+            return
+
         for line in lines:
+            if line[-1:] == "\r":
+                line = line[:-1]
+
             if DEBUG:
                 print "FROM SERVER:", line
 
             if not line:
                 continue
 
+            raw_line = line
             line = self._decode(line)
 
-            prefix = None
-            command = None
             arguments = None
             self._handle_event(Event("all_raw_messages",
                                      self.get_server_name(),
                                      None,
                                      [line]))
 
-            m = _rfc_1459_command_regexp.match(line)
-            if m.group("prefix"):
-                prefix = m.group("prefix")
+            prefix, command, argument = _split_message(line)
+            if prefix:
                 if not self.real_server_name:
                     self.real_server_name = prefix
+            else:
+                prefix = None
 
-            if m.group("command"):
-                command = m.group("command").lower()
+            if command:
+                command = command.lower()
 
-            if m.group("argument"):
-                a = m.group("argument").split(" :", 1)
+            if argument:
+                a = argument.split(" :", 1)
                 arguments = a[0].split()
                 if len(a) == 2:
                     arguments.append(a[1])
 
+            # Formatting codes are rare, don't look for them in every
+            # argument when the line has none.
+            formatted = "\x02" in line or "\x03" in line or "\x1f" in line
+
             # Translate numerics into more readable strings.
             if command in numeric_events:
                 command = numeric_events[command]
 
             if command in ["privmsg", "notice"]:
                 target, message = arguments[0], arguments[1]
-                messages = _ctcp_dequote(message)
+                if _CTCP_DELIMITER in message or _LOW_LEVEL_QUOTE in message:
+                    messages = _ctcp_dequote(message)
+                else:
+                    messages = [message]
 
                 if command == "privmsg":
                     if is_channel(target):
@@ -785,8 +1584,9 @@ class ServerConnection(Connection):
                                 command, prefix, target, m)
 
                         # Remove formatting
-                        for i in range(len(m)):
-                            m[i] = strip_formatting_re.sub('', m[i])
+                        if formatted:
+                            for i in range(len(m)):
+                                m[i] = strip_formatting_re.sub('', m[i])
 
                         self._handle_event(Event(command, prefix, target, m))
                         if command == "ctcp" and m[0] == "ACTION":
@@ -795,10 +1595,16 @@ class ServerConnection(Connection):
                         if DEBUG:
                             print "command: %s, source: %s, target: %s, arguments: %s" % (
                                 command, prefix, target, [m])
-                        self._handle_event(Event(command, prefix, target, [strip_formatting_re.sub('', m)]))
+                        if formatted:
+                            m = strip_formatting_re.sub('', m)
+                        self._handle_event(Event(command, prefix, target, [m]))
             else:
                 target = None
 
+                if command in ["quit", "nick"] and self.nick_codecs and prefix:
+                    # the client of the user may change, forget its charset
+                    self.nick_codecs.pop(_sender_nick(raw_line), None)
+
                 if command == "quit":
                     arguments = [arguments[0]]
                 elif command == "ping":
@@ -815,6 +1621,7 @@ class ServerConnection(Connection):
                     self.logged_in = True
                     if self.new_nickname and isinstance(target, basestring):
                         self.real_nickname = target
+                        self.irclibobj._reindex_connection(self)
                         if self.new_nickname != target:
                             if len(self.new_nickname) > len(target):
                                 self._handle_event(Event('nicknametoolong', None, None, None))
@@ -841,18 +1648,20 @@ class ServerConnection(Connection):
                         command, prefix, target, arguments)
 
                 # Remove formatting
-                for i in range(len(arguments)):
-                    arguments[i] = strip_formatting_re.sub('', arguments[i])
+                if formatted:
+                    for i in range(len(arguments)):
+                        arguments[i] = strip_formatting_re.sub('', arguments[i])
 
                 self._handle_event(Event(command, prefix, target, arguments))
 
     def _handle_event(self, event):
         """[Internal]"""
         self.irclibobj._handle_event(self, event)
-        if event.eventtype() in ['disconnect', 'nicknameinuse', 'nickcollision', 'erroneusnickname', 'nicknametoolong']:
-            self._call_nick_callbacks(event.eventtype(), arguments=[event])
-        if event.eventtype() in self.handlers:
-            for fn in self.handlers[event.eventtype()]:
+        eventtype = event.eventtype()
+        if eventtype in _nick_callback_events:
+            self._call_nick_callbacks(eventtype, arguments=[event])
+        if eventtype in self.handlers:
+            for fn in self.handlers[eventtype]:
                 fn(self, event)
 
     def add_global_handler(self, *args):
@@ -896,15 +1705,22 @@ class ServerConnection(Connection):
 
         self.lock.acquire()
 
+        connected = self.connected
         if self.connected:
             self.connected = False
         if self.logged_in:
             self.logged_in = False
+        if self.connect_timer:
+            self.connect_timer.cancel()
+            self.connect_timer = None
+        self.connecting = False
+        self._reset_flood_control()
 
         if self.socket and self.socket != 'closed':
-            if message and message != 'Connection reset by peer':
+            if connected and message and message != 'Connection reset by peer':
                 self.quit(message)
 
+            self.irclibobj._unregister_socket(self)
             try:
                 self.socket.close()
             except socket.error, x:
@@ -1037,17 +1853,17 @@ class ServerConnection(Connection):
         self.send_raw("PONG %s%s" % (target, target2 and (" " + target2)))
 
     def privmsg(self, target, text):
-        """Send a PRIVMSG command."""
+        """Send a PRIVMSG command.
+
+        Each line of text is split in as many messages as needed to fit
+        in the size limit once relayed by the server, preferably on
+        spaces and never inside a UTF-8 character.
+        """
+        # 510 is the size limit for IRC messages defined in RFC 2812
+        available_size = 510-len(('%s PRIVMSG %s :' % (self.irc_id, target)).encode('utf-8'))-1
         for l in text.split('\n'):
-            l_size = len(l.encode('utf-8'))
-            available_size = float(510-len('%s PRIVMSG %s :' % (self.irc_id, target)))  # 510 is the size limit for IRC messages defined in RFC 2812
-            e = 0
-            for i in range(int(math.ceil(l_size/available_size))):
-                s = e
-                e = s+int(available_size)
-                while len(l[s:e].encode('utf-8')) >= available_size:
-                    e -= 1
-                self.send_raw("PRIVMSG %s :%s" % (target, l[s:e]))
+            for chunk in _split_utf8(l.encode('utf-8'), available_size):
+                self.send_raw("PRIVMSG %s :%s" % (target, chunk.decode('utf-8')))
 
     def privmsg_many(self, targets, text):
         """Send a PRIVMSG command to multiple targets."""
@@ -1067,19 +1883,175 @@ class ServerConnection(Connection):
         """Send raw string to the server.
 
         The string will be padded with appropriate CR LF.
+
+        The data is appended to the send buffer of the connection and
+        written as soon as the socket accepts it, this method never
+        blocks on the network.
+
+        Lines are subject to flood control: when the server would
+        consider them as a flood they are kept in a queue and released
+        at the rate set by IRC.flood_control, registration, PING/PONG
+        and channel commands being released before messages.
         """
-        if not self.socket or isinstance(self.socket, basestring):
+        if not self.socket or isinstance(self.socket, basestring) or self.connecting:
             raise ServerNotConnectedError, self
-        try:
-            if self.ssl:
-                self.ssl.write(string.encode('utf-8') + "\r\n")
+        data = string.encode('utf-8') + "\r\n"
+        command = data.split(' ', 1)[0].upper()
+        self.send_lock.acquire()
+        if command in _flood_exempt_commands:
+            self._buffer(data)
+        else:
+            self._refill_flood_tokens()
+            if self.flood_queued == 0 and self.flood_tokens >= 1:
+                self.flood_tokens -= 1
+                self._buffer(data)
             else:
-                self.socket.send(string.encode('utf-8') + "\r\n")
-            if DEBUG:
-                print "TO SERVER:", string
-        except socket.error, x:
-            # Ouch!
-            self.disconnect("Connection reset by peer")
+                self.flood_queues[_flood_priorities.get(command, _flood_priority_levels-1)].append(data)
+                self.flood_queued += 1
+                if self.throttled_since is None:
+                    self.throttled_since = time.time()
+                self._schedule_flood_release()
+        self.send_lock.release()
+        if DEBUG:
+            print "TO SERVER:", string
+        # if data is already waiting the socket isn't writable, leave
+        # the writing to the reactor
+        self.flush(write=not self.writing)
+
+    def _buffer(self, data):
+        """[Internal] Must be called with the send lock held."""
+        self.send_queue.append(data)
+        self.send_buffer_size += len(data)
+        self.bytes_queued += len(data)
+
+    def _refill_flood_tokens(self):
+        """[Internal] Must be called with the send lock held."""
+        now = time.time()
+        burst, rate = self.irclibobj.flood_control(server=self._server_str())
+        self.flood_tokens = min(burst, self.flood_tokens + (now - self.flood_last_refill) * rate)
+        self.flood_last_refill = now
+
+    def _schedule_flood_release(self):
+        """[Internal] Must be called with the send lock held."""
+        if self.flood_timer:
+            return
+        burst, rate = self.irclibobj.flood_control(server=self._server_str())
+        self.flood_timer = self.execute_delayed(max(0, (1 - self.flood_tokens) / rate), self._release_flood_queue)
+
+    def _release_flood_queue(self):
+        """[Internal] Move the lines allowed by flood control to the send buffer."""
+        self.send_lock.acquire()
+        self.flood_timer = None
+        self._refill_flood_tokens()
+        for queue in self.flood_queues:
+            while queue and self.flood_tokens >= 1:
+                self.flood_tokens -= 1
+                self.flood_queued -= 1
+                self._buffer(queue.popleft())
+        if self.flood_queued:
+            self._schedule_flood_release()
+        elif self.throttled_since is not None:
+            self.throttled_time += time.time() - self.throttled_since
+            self.throttled_since = None
+        self.send_lock.release()
+        if self.socket and not isinstance(self.socket, basestring):
+            self.flush(write=not self.writing)
+
+    def _reset_flood_control(self):
+        """[Internal] Drop the lines waiting for flood control and refill the tokens."""
+        self.send_lock.acquire()
+        if self.flood_timer:
+            self.flood_timer.cancel()
+            self.flood_timer = None
+        for queue in self.flood_queues:
+            queue.clear()
+        self.flood_queued = 0
+        if self.throttled_since is not None:
+            self.throttled_time += time.time() - self.throttled_since
+            self.throttled_since = None
+        self.flood_tokens = self.irclibobj.flood_control(server=self._server_str())[0]
+        self.flood_last_refill = time.time()
+        self.send_lock.release()
+
+    def get_flood_stats(self):
+        """Returns the number of lines waiting for flood control and the number of seconds spent throttled."""
+        self.send_lock.acquire()
+        throttled_time = self.throttled_time
+        if self.throttled_since is not None:
+            throttled_time += time.time() - self.throttled_since
+        queued = self.flood_queued
+        self.send_lock.release()
+        return queued, throttled_time
+
+    def flush(self, write=True):
+        """Write as much of the send buffer as the socket accepts without blocking.
+
+        Called by send_raw and by the reactor when the socket becomes
+        writable.
+        """
+        error = None
+        self.send_lock.acquire()
+        while write and self.send_queue:
+            data = self.send_queue[0]
+            if len(data) < 2**14 and len(self.send_queue) > 1 and not self.send_retry:
+                # coalesce small lines into one write, but OpenSSL needs
+                # the same buffer when it retries a write that would block
+                chunks = []
+                size = 0
+                while self.send_queue and size < 2**14:
+                    chunks.append(self.send_queue.popleft())
+                    size += len(chunks[-1])
+                data = ''.join(chunks)
+                self.send_queue.appendleft(data)
+            try:
+                if self.ssl:
+                    n = self.ssl.write(data)
+                else:
+                    n = self.socket.send(data)
+            except ssl.SSLError, x:
+                if x.args[0] not in (ssl.SSL_ERROR_WANT_WRITE, ssl.SSL_ERROR_WANT_READ):
+                    error = x
+                else:
+                    self.send_retry = True
+                n = 0
+            except socket.error, x:
+                if x.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    error = x
+                n = 0
+            except AttributeError:
+                # the socket has been closed
+                error = True
+                n = 0
+            self.bytes_sent += n
+            self.send_buffer_size -= n
+            if n:
+                self.send_retry = False
+            if n < len(data):
+                self.send_queue[0] = data[n:]
+                break
+            self.send_queue.popleft()
+        if error:
+            # The connection is broken, the reactor will report the
+            # hangup to process_data which disconnects.  Disconnecting
+            # here could deadlock when called from another thread.
+            self.send_queue.clear()
+            self.send_buffer_size = 0
+            self.send_retry = False
+        buffer_size = self.send_buffer_size
+        if (buffer_size > 0) != self.writing:
+            # only watch writability while there is something to write
+            self.writing = buffer_size > 0
+            if self.writing:
+                self.irclibobj._modify_socket(self, REACTOR_READ | REACTOR_WRITE)
+            else:
+                self.irclibobj._modify_socket(self, REACTOR_READ)
+        full = buffer_size > self.irclibobj.send_buffer_high_water
+        newly_full = full and not self.send_buffer_full
+        self.send_buffer_full = full
+        self.send_lock.release()
+
+        if newly_full and self.irclibobj.fn_send_buffer_full:
+            self.irclibobj.fn_send_buffer_full(self, buffer_size)
 
     def squit(self, server, comment=""):
         """Send an SQUIT command."""
@@ -1138,6 +2110,346 @@ class ServerConnection(Connection):
                                          max and (" " + max),
                                          server and (" " + server)))
 
+_uid_characters = string.ascii_uppercase + string.digits
+
+class ServerLink(ServerConnection):
+    """This class represents a server-to-server link using the TS6
+    protocol.
+
+    The link introduces PseudoClient objects on the network, all of
+    them share its socket instead of having their own connection.
+    ServerLink objects are instantiated by calling the open_link
+    method on an IRC object.
+    """
+
+    def __init__(self, irclibobj, server, port, name, sid, password, description):
+        ServerConnection.__init__(self, irclibobj, server, port, name)
+        self.sid = sid
+        self.link_password = password
+        self.description = description
+        self.clients = {}
+        self.users = {}
+        self.next_uid = 0
+        self.network = None
+
+    def connect(self):
+        """Connect to the hub, the pseudo-clients are introduced once the link is established."""
+        self.lock.acquire()
+        if self.socket is None or self.socket == 'closed':
+            server_str = self._server_str()
+            stacks = self.irclibobj.connection_stacks
+            if not stacks.has_key(server_str):
+                stacks[server_str] = []
+                delay = self.irclibobj.connection_interval(server=server_str)
+                self.irclibobj.execute_delayed(delay, self.irclibobj._connection_loop, (server_str,))
+            if (self._connect, ()) not in stacks[server_str]:
+                self.used_by = 1
+                self.real_nickname = self.nickname
+                self.password = None
+                self.localaddress = ""
+                self.localport = 0
+                self.ssl = False
+                self.ipv6 = False
+                if not self.irclibobj.charsets.has_key(server_str):
+                    self.irclibobj.charsets[server_str] = None
+                stacks[server_str].append( (self._connect, ()) )
+        self.lock.release()
+        return self
+
+    def _logon(self):
+        """[Internal] The connection is ready, register and burst the pseudo-clients."""
+        if self.connect_timer:
+            self.connect_timer.cancel()
+            self.connect_timer = None
+        self.connecting = False
+        self.connected = True
+        self.send_queue = collections.deque()
+        self.send_buffer_size = 0
+        self.send_buffer_full = False
+        self.send_retry = False
+        self.writing = False
+        self.users = {}
+        self.irclibobj._modify_socket(self, REACTOR_READ)
+        if self.irclibobj.fn_to_add_socket:
+            self.irclibobj.fn_to_add_socket(self.socket)
+
+        self.send_raw("PASS %s TS 6 :%s" % (self.link_password, self.sid))
+        self.send_raw("CAPAB :QS ENCAP SERVICES")
+        self.send_raw("SERVER %s 1 :%s" % (self.nickname, self.description))
+        self.send_raw("SVINFO 6 6 0 :%d" % time.time())
+        self.logged_in = True
+        for client in self.clients.values():
+            self._introduce(client)
+
+    def open_client(self, nickname):
+        """Creates or returns an existing PseudoClient object for nickname."""
+        c = self.irclibobj.get_connection(self.network[0], self.network[1], nickname)
+        if isinstance(c, PseudoClient):
+            return c
+        n = self.next_uid
+        self.next_uid += 1
+        uid = ""
+        for i in range(5):
+            uid = _uid_characters[n % 36] + uid
+            n = n // 36
+        c = PseudoClient(self, nickname, self.sid + "A" + uid)
+        self.irclibobj._add_connection(c)
+        return c
+
+    def introduce(self, client):
+        """[Internal] Introduce client on the network, or as soon as the link is established."""
+        self.lock.acquire()
+        self.clients[client.uid] = client
+        if self.logged_in:
+            self._introduce(client)
+        else:
+            self.connect()
+        self.lock.release()
+
+    def _introduce(self, client):
+        """[Internal]"""
+        self.send_raw(":%s UID %s 1 %d +i %s %s 0 %s :%s" % (self.sid, client.real_nickname, time.time(), client.username, self.nickname, client.uid, client.ircname))
+        client._introduced()
+
+    def send_raw(self, string):
+        """Send raw string to the hub.
+
+        Server links are not subject to flood control, the lines are
+        appended to the send buffer right away.
+        """
+        if not self.socket or isinstance(self.socket, basestring) or self.connecting:
+            raise ServerNotConnectedError, self
+        data = string.encode('utf-8') + "\r\n"
+        self.send_lock.acquire()
+        self._buffer(data)
+        self.send_lock.release()
+        if DEBUG:
+            print "TO HUB:", string
+        self.flush(write=not self.writing)
+
+    def disconnect(self, message="", volontary=False):
+        """Hang up the link, the pseudo-clients are disconnected too."""
+        self.lock.acquire()
+        logged_in = self.logged_in
+        self.logged_in = False
+        self.lock.release()
+        if logged_in and message and message != 'Connection reset by peer':
+            try:
+                self.send_raw("SQUIT %s :%s" % (self.nickname, message))
+            except ServerNotConnectedError:
+                pass
+        ServerConnection.disconnect(self, volontary=volontary)
+        for client in self.clients.values():
+            client._link_lost()
+
+    def process_data(self):
+        """[Internal]"""
+
+        lines = self._receive()
+        if not lines:
+            return
+
+        for line in lines:
+            if line[-1:] == "\r":
+                line = line[:-1]
+
+            if DEBUG:
+                print "FROM HUB:", line
+
+            if not line:
+                continue
+
+            line = self._decode(line)
+            prefix, command, argument = _split_message(line)
+            arguments = []
+            if argument:
+                a = argument.split(" :", 1)
+                arguments = a[0].split()
+                if len(a) == 2:
+                    arguments.append(a[1])
+            if command:
+                self._process_command(prefix, command.upper(), arguments)
+
+    def _process_command(self, prefix, command, arguments):
+        """[Internal] Keep track of the users of the network and pass the messages to the pseudo-clients."""
+        if command == "PING":
+            self.send_raw(":%s PONG %s :%s" % (self.sid, self.nickname, arguments[0]))
+        elif command == "SERVER":
+            if not self.real_server_name:
+                self.real_server_name = arguments[0]
+        elif command in ["UID", "EUID"]:
+            self.users[arguments[7]] = "%s!%s@%s" % (arguments[0], arguments[4], arguments[5])
+        elif command == "NICK" and prefix in self.users:
+            self.users[prefix] = arguments[0] + "!" + self.users[prefix].split("!", 1)[1]
+        elif command == "QUIT":
+            self.users.pop(prefix, None)
+        elif command in ["KILL", "SAVE"]:
+            client = self.clients.get(arguments[0])
+            if client:
+                # a nick collision, the network keeps the other user
+                if command == "SAVE":
+                    self.send_raw(":%s QUIT :Nick collision" % client.uid)
+                client._collided()
+            elif command == "KILL":
+                self.users.pop(arguments[0], None)
+        elif command in ["PRIVMSG", "NOTICE"] and len(arguments) == 2:
+            client = self.clients.get(arguments[0])
+            if client is None and not is_channel(arguments[0]):
+                target = irc_lower(arguments[0].split("@", 1)[0].encode('utf-8'))
+                for c in self.clients.itervalues():
+                    if irc_lower(c.real_nickname.encode('utf-8')) == target:
+                        client = c
+                        break
+            if client:
+                client._receive_message(self.users.get(prefix, prefix), command.lower(), arguments[1])
+        elif command == "ERROR":
+            self.disconnect("Connection reset by peer")
+
+
+class PseudoClient(ServerConnection):
+    """This class represents a user introduced on the network by a
+    ServerLink.
+
+    It has the interface of ServerConnection, the commands are sent
+    through the link with the UID of the client as source.
+    PseudoClient objects are instantiated by calling the open_client
+    method on a ServerLink object.
+    """
+
+    def __init__(self, link, nickname, uid):
+        ServerConnection.__init__(self, link.irclibobj, link.network[0], link.network[1], nickname)
+        self.link = link
+        self.uid = uid
+        self.lock = link.lock
+        self.real_nickname = nickname
+
+    def connect(self, password=None, username=None,
+                ircname=None, localaddress="", localport=0, ssl=False, ipv6=False, nick_callback=None, charsets=None):
+        """Introduce the client on the network.
+
+        The arguments are those of ServerConnection.connect, only
+        username, ircname and nick_callback are used.
+        """
+        self.lock.acquire()
+        if nick_callback:
+            self.add_nick_callback(nick_callback)
+        if self.used_by > 0:
+            if not self.connected:
+                # the link has been lost, introduce the client again
+                self.link.introduce(self)
+            else:
+                self.used_by += 1
+                self._call_nick_callbacks(None)
+            self.lock.release()
+            return self
+        self.used_by = 1
+        self.real_nickname = self.nickname
+        self.irclibobj._reindex_connection(self)
+        self.username = username or "xib"
+        self.ircname = ircname or self.nickname
+        self.link.introduce(self)
+        self.lock.release()
+        return self
+
+    def _introduced(self):
+        """[Internal] The link told the network about the client."""
+        self.connected = True
+        self.logged_in = True
+        self.real_server_name = self.link.nickname
+        self.irc_id = "%s!%s@%s" % (self.real_nickname, self.username, self.link.nickname)
+        for channel in self.channels.values():
+            if channel.state >= JOINING:
+                channel.rejoin()
+        self._call_nick_callbacks(None)
+
+    def _collided(self):
+        """[Internal] The network killed the client because of a nick collision."""
+        self.connected = False
+        self.logged_in = False
+        self.link.clients.pop(self.uid, None)
+        self._handle_event(Event("nickcollision", self.link.get_server_name(), None, [self.real_nickname]))
+
+    def _link_lost(self):
+        """[Internal]"""
+        self.connected = False
+        self.logged_in = False
+        self._handle_event(Event("disconnect", self.server, "", ["Connection reset by peer"]))
+
+    def _receive_message(self, source, command, message):
+        """[Internal] Generate the events of a message addressed to the client."""
+        if _CTCP_DELIMITER in message or _LOW_LEVEL_QUOTE in message:
+            messages = _ctcp_dequote(message)
+        else:
+            messages = [message]
+        if command == "notice":
+            command = "privnotice"
+        for m in messages:
+            if type(m) is types.TupleType:
+                m = list(m)
+                if command == "privmsg":
+                    self._handle_event(Event("ctcp", source, self.real_nickname, m))
+                    if m[0] == "ACTION":
+                        self._handle_event(Event("action", source, self.real_nickname, m[1:]))
+                else:
+                    self._handle_event(Event("ctcpreply", source, self.real_nickname, m))
+            else:
+                self._handle_event(Event(command, source, self.real_nickname, [strip_formatting_re.sub('', m)]))
+
+    def _get_socket(self):
+        """[Internal] A pseudo-client has no socket of its own."""
+        return None
+
+    def disconnect(self, message="", volontary=False):
+        """Make the client quit the network.
+
+        Arguments:
+
+            message -- Quit message.
+        """
+        self.lock.acquire()
+        if self.connected:
+            self.connected = False
+            self.logged_in = False
+            try:
+                self.link.send_raw(":%s QUIT :%s" % (self.uid, message))
+            except ServerNotConnectedError:
+                pass
+        self.link.clients.pop(self.uid, None)
+        self.used_by = 0
+        self.lock.release()
+
+        if volontary == False:
+            self._handle_event(Event("disconnect", self.server, "", [message]))
+
+    def send_raw(self, string):
+        """Send a client command through the link.
+
+        The commands which differ between clients and servers are
+        translated to their TS6 form, those that only make sense on a
+        client connection are dropped.
+        """
+        if not self.connected:
+            raise ServerNotConnectedError, self
+        command, _, rest = string.partition(" ")
+        command = command.upper()
+        if command in ["PASS", "USER", "PING", "PONG"]:
+            return
+        if command == "JOIN":
+            channel = rest.split(" ", 1)[0]
+            self.link.send_raw(":%s JOIN %d %s +" % (self.uid, time.time(), channel))
+            # the hub does not acknowledge joins from servers
+            if channel in self.channels:
+                self.channels[channel]._callback(None)
+        elif command == "NICK":
+            self.link.send_raw(":%s NICK %s :%d" % (self.uid, rest, time.time()))
+            self.real_nickname = rest
+            self.irclibobj._reindex_connection(self)
+            self.irc_id = "%s!%s@%s" % (rest, self.username, self.link.nickname)
+            self.new_nickname = None
+            self._call_nick_callbacks(None)
+        else:
+            self.link.send_raw(":%s %s" % (self.uid, string))
+
 class DCCConnectionError(IRCError):
     pass
 
@@ -1178,6 +2490,7 @@ class DCCConnection(Connection):
         except socket.error, x:
             raise DCCConnectionError, "Couldn't connect to socket: %s" % x
         self.connected = True
+        self.irclibobj._register_socket(self)
         if self.irclibobj.fn_to_add_socket:
             self.irclibobj.fn_to_add_socket(self.socket)
         return self
@@ -1202,6 +2515,7 @@ class DCCConnection(Connection):
             self.socket.listen(10)
         except socket.error, x:
             raise DCCConnectionError, "Couldn't bind socket: %s" % x
+        self.irclibobj._register_socket(self)
         return self
 
     def disconnect(self, message=""):
@@ -1215,6 +2529,7 @@ class DCCConnection(Connection):
             return
 
         self.connected = False
+        self.irclibobj._unregister_socket(self)
         try:
             self.socket.close()
         except socket.error, x:
@@ -1230,9 +2545,11 @@ class DCCConnection(Connection):
 
         if self.passive and not self.connected:
             conn, (self.peeraddress, self.peerport) = self.socket.accept()
+            self.irclibobj._unregister_socket(self)
             self.socket.close()
             self.socket = conn
             self.connected = True
+            self.irclibobj._register_socket(self)
             if DEBUG:
                 print "DCC connection from %s:%d" % (
                     self.peeraddress, self.peerport)
@@ -1382,6 +2699,21 @@ def irc_lower(s):
     """
     return s.translate(_ircstring_translation)
 
+def _sender_nick(line):
+    """[Internal] Returns the nickname in the prefix of the raw line, or None."""
+    if line[:1] != ":":
+        return None
+    end = line.find(" ")
+    if end == -1:
+        return None
+    return line[1:end].split("!", 1)[0]
+
+def _connection_key(server, port, nickname):
+    """[Internal] Returns the key of nickname at server:port in IRC.connections_by_nickname."""
+    if isinstance(nickname, unicode):
+        nickname = nickname.encode("utf-8")
+    return (server, port, irc_lower(nickname))
+
 def _ctcp_dequote(message):
     """[Internal] Dequote a message according to CTCP specifications.
 
@@ -19,6 +19,41 @@ import xmppony as xmpp
 from time import sleep
 
 
+class PresenceRouter:
+	"""Passes the presences received by an XMPP connection to the muc objects waiting for them.
+	
+	A single handler is registered on the connection instead of one per muc, the muc objects are found by the full JID of their occupant."""
+	
+	def __init__(self, xmpp_c):
+		self.mucs = {}
+		xmpp_c.RegisterHandler('presence', self._xmpp_presence_handler)
+	
+	
+	def add(self, m):
+		self.mucs[unicode(xmpp.protocol.JID(m.jid))] = m
+	
+	
+	def remove(self, m):
+		key = unicode(xmpp.protocol.JID(m.jid))
+		if self.mucs.get(key) is m:
+			del self.mucs[key]
+	
+	
+	def _xmpp_presence_handler(self, xmpp_c, presence):
+		m = self.mucs.get(unicode(presence.getFrom()))
+		if m != None:
+			m._xmpp_presence_handler(xmpp_c, presence)
+
+
+def get_presence_router(xmpp_c):
+	"""Returns the PresenceRouter of xmpp_c, creating it if needed."""
+	xmpp_c.lock.acquire()
+	if not hasattr(xmpp_c, 'presence_router'):
+		xmpp_c.presence_router = PresenceRouter(xmpp_c)
+	xmpp_c.lock.release()
+	return xmpp_c.presence_router
+
+
 class muc:
 	
 	class PasswordNeeded(Exception): pass
@@ -42,7 +77,7 @@ class muc:
 	def _join(self, callback=None):
 		self.state = self.JOINING
 		self.callback = callback
-		self.xmpp_c.RegisterHandler('presence', self._xmpp_presence_handler)
+		get_presence_router(self.xmpp_c).add(self)
 		s = xmpp.protocol.Presence(to=self.jid, status=self.status, payload=[xmpp.simplexml.Node(tag='x', attrs={'xmlns': 'http://jabber.org/protocol/muc'}, payload=[xmpp.simplexml.Node(tag='history', attrs={'maxchars': '0'})])])
 		self._send(s, force=True)
 	
@@ -78,6 +113,7 @@ class muc:
 	
 	
 	def _xmpp_presence_handler(self, xmpp_c, presence):
+		"""[Internal] Called by the PresenceRouter with the presences of our occupant JID while joining."""
 		if presence.getFrom() == self.jid:
 			errors = []
 			if presence.getAttr('type') == 'error':
@@ -117,7 +153,7 @@ class muc:
 					errors.append(self.__class__.UnknownError(presence.__str__(fancy=1).encode('utf-8')))
 			else:
 				self.state = self.JOINED
-				xmpp_c.UnregisterHandler('presence', self._xmpp_presence_handler)
+				get_presence_router(self.xmpp_c).remove(self)
 			if self.callback != None:
 				self.callback(errors)
 	
@@ -144,9 +180,11 @@ class muc:
 	
 	def change_nick(self, nickname, status=None, callback=None):
 		"""Change nickname"""
+		router = get_presence_router(self.xmpp_c)
+		router.remove(self)
 		self.jid = self.room_jid+'/'+nickname
 		self.callback = callback
-		self.xmpp_c.RegisterHandler('presence', self._xmpp_presence_handler)
+		router.add(self)
 		self.xmpp_c.lock.acquire()
 		s = xmpp.protocol.Presence(to=self.jid, status=status)
 		self._send(s)
@@ -174,6 +212,7 @@ class muc:
 	
 	def __del__(self):
 		self.leave()
+		get_presence_router(self.xmpp_c).remove(self)
 		if self in self.xmpp_c.mucs:
 			self.xmpp_c.mucs.remove(self)
 
@@ -23,10 +23,16 @@ import muc
 xmpp = muc.xmpp
 del muc
 
+from component import xmpp_connection_types
 import say_levels
 
 
-class Participant:
+class Participant(object):
+	
+	# there can be thousands of participants in a bridge, slots avoid a __dict__ per participant
+	__slots__ = ['bot_admin', 'real_jid', 'bridge', 'protocol', 'nickname', 'duplicate_nickname', 'irc_connection', 'xmpp_c', 'muc', 'left']
+	
+	
 	def __init__(self, owner_bridge, protocol, nickname, real_jid=None):
 		self.bot_admin = False
 		self.real_jid = real_jid
@@ -53,10 +59,19 @@ class Participant:
 		return None
 	
 	
+	def set_xmpp_connection(self, c):
+		"""Set the XMPP connection used by the duplicate of the participant, and keep the lists of participants of the XMPP connections up to date."""
+		if isinstance(self.xmpp_c, xmpp_connection_types) and self in self.xmpp_c.participants:
+			self.xmpp_c.participants.remove(self)
+		self.xmpp_c = c
+		if isinstance(c, xmpp_connection_types):
+			c.participants.append(self)
+	
+	
 	def create_duplicate_on_xmpp(self):
-		if isinstance(self.xmpp_c, xmpp.client.Client) or isinstance(self.irc_connection, irclib.ServerConnection):
+		if isinstance(self.xmpp_c, xmpp_connection_types) or isinstance(self.irc_connection, irclib.ServerConnection):
 			return
-		self.xmpp_c = self.bridge.bot.get_xmpp_connection(self.duplicate_nickname)
+		self.set_xmpp_connection(self.bridge.bot.get_xmpp_connection(self.duplicate_nickname))
 		self.muc = xmpp.muc(self.bridge.xmpp_room_jid)
 		self.join_muc()
 	
@@ -87,9 +102,10 @@ class Participant:
 							if self.duplicate_nickname == self.nickname:
 								self.bridge.say(say_levels.info, 'The nickname "'+self.duplicate_nickname+'" is used on both rooms or reserved on the XMPP server')
 							self.duplicate_nickname = new_duplicate_nickname
-							if isinstance(self.xmpp_c, xmpp.client.Client):
+							self.bridge.reindex_participant(self)
+							if isinstance(self.xmpp_c, xmpp_connection_types):
 								self.bridge.bot.close_xmpp_connection(self.nickname)
-								self.xmpp_c = None
+								self.set_xmpp_connection(None)
 							self.create_duplicate_on_xmpp()
 							return
 					
@@ -106,9 +122,13 @@ class Participant:
 	
 	
 	def create_duplicate_on_irc(self):
-		if isinstance(self.xmpp_c, xmpp.client.Client) or isinstance(self.irc_connection, irclib.ServerConnection):
+		if isinstance(self.xmpp_c, xmpp_connection_types) or isinstance(self.irc_connection, irclib.ServerConnection):
 			return
-		self.irc_connection = self.bridge.bot.irc.open_connection(self.bridge.irc_server, self.bridge.irc_port, self.duplicate_nickname)
+		link = self.bridge.bot.irc.get_link(self.bridge.irc_server, self.bridge.irc_port)
+		if link:
+			self.irc_connection = link.open_client(self.duplicate_nickname)
+		else:
+			self.irc_connection = self.bridge.bot.irc.open_connection(self.bridge.irc_server, self.bridge.irc_port, self.duplicate_nickname)
 		self.irc_connection.connect(nick_callback=self._irc_nick_callback)
 	
 	
@@ -129,6 +149,7 @@ class Participant:
 						if self.duplicate_nickname == self.nickname:
 							self.bridge.say(say_levels.info, 'The nickname "'+self.duplicate_nickname+'" is used or reserved on the IRC server')
 						self.duplicate_nickname = new_duplicate_nickname
+						self.bridge.reindex_participant(self)
 						if isinstance(self.irc_connection, irclib.ServerConnection):
 							self.irc_connection.close('')
 							self.irc_connection = error
@@ -141,6 +162,7 @@ class Participant:
 			elif error == 'erroneusnickname':
 				if self.bridge.mode == 'bypass':
 					self.duplicate_nickname = re.sub('[^a-zA-Z]', '', self.nickname)
+					self.bridge.reindex_participant(self)
 					if isinstance(self.irc_connection, irclib.ServerConnection):
 						self.irc_connection.close('')
 						self.irc_connection = error
@@ -183,7 +205,7 @@ class Participant:
 			self.muc.leave('')
 			self.bridge.bot.close_xmpp_connection(self.nickname)
 		if self.xmpp_c != 'both':
-			self.xmpp_c = 'both'
+			self.set_xmpp_connection('both')
 	
 	
 	def change_nickname(self, newnick, on_protocol):
@@ -203,6 +225,7 @@ class Participant:
 				except self.bridge.NoSuchParticipantException:
 					self.nickname = newnick
 					self.duplicate_nickname = newnick
+					self.bridge.reindex_participant(self)
 					has_connection = self.bridge.bot.irc.has_connection(self.bridge.irc_server, self.bridge.irc_port, self.duplicate_nickname)
 					if isinstance(self.irc_connection, irclib.ServerConnection):
 						if not has_connection and self.irc_connection.used_by == 1:
@@ -219,19 +242,20 @@ class Participant:
 		elif self.protocol == 'irc':
 			if on_protocol == 'irc':
 				self._close_xmpp_connection('unwanted nick change')
-				self.xmpp_c = 'unwanted nick change'
+				self.set_xmpp_connection('unwanted nick change')
 			
 			else:
 				try:
-					p = self.bridge.get_participant(newnick)
+					p = self.bridge.get_participant(newnick, irc=True)
 				except self.bridge.NoSuchParticipantException:
 					self.nickname = newnick
 					self.duplicate_nickname = newnick
+					self.bridge.reindex_participant(self)
 					if isinstance(self.muc, xmpp.muc):
-						for b in self.bridge.bot.bridges:
-							if b.has_participant(oldnick) and b.irc_server != self.bridge.irc_server:
+						for irc_server in self.bridge.bot.participants_by_irc_server.keys():
+							if irc_server != self.bridge.irc_server and self.bridge.bot.get_participants(irc_server, oldnick):
 								self.muc.leave(message='Changed nickname to "'+self.nickname+'"')
-								self.xmpp_c = None
+								self.set_xmpp_connection(None)
 								self.bridge.bot.close_xmpp_connection(oldnick)
 								self.create_duplicate_on_xmpp()
 								return
@@ -250,6 +274,7 @@ class Participant:
 		
 		self.nickname = newnick
 		self.duplicate_nickname = newnick
+		self.bridge.reindex_participant(self)
 		
 		if not isinstance(p, Participant):
 			return
@@ -269,11 +294,12 @@ class Participant:
 					self.irc_connection = p.irc_connection
 					p.irc_connection = None
 				else:
-					self.xmpp_c = p.xmpp_c
+					self.set_xmpp_connection(p.xmpp_c)
 					self.muc = p.muc
-					p.xmpp_c = None
+					p.set_xmpp_connection(None)
 					p.muc = None
 				p.duplicate_nickname = p._get_new_duplicate_nickname()
+				self.bridge.reindex_participant(p)
 				p.create_duplicate_on_xmpp()
 		else:
 			# should never happen
@@ -296,7 +322,7 @@ class Participant:
 			except irclib.ServerNotConnectedError:
 				self.irc_connection.connect()
 				bot_say = True
-		elif not isinstance(self.xmpp_c, xmpp.client.Client):
+		elif not isinstance(self.xmpp_c, xmpp_connection_types):
 			bot_say = True
 		if bot_say:
 			self.bridge.say_on_behalf(self.nickname, message, 'irc', action=action)
@@ -310,7 +336,7 @@ class Participant:
 			except irclib.ServerNotConnectedError:
 				self.irc_connection.connect()
 				error = True
-		elif not isinstance(self.xmpp_c, xmpp.client.Client):
+		elif not isinstance(self.xmpp_c, xmpp_connection_types):
 			error = True
 		
 		if error:
@@ -348,7 +374,7 @@ class Participant:
 	def _close_xmpp_connection(self, message):
 		if isinstance(self.muc, xmpp.muc):
 			self.muc.leave(message)
-			self.xmpp_c = None
+			self.set_xmpp_connection(None)
 			self.bridge.bot.close_xmpp_connection(self.nickname)
 	
 	
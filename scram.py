@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import base64
+import hashlib
+import hmac
+import os
+import threading
+
+import muc
+xmpp = muc.xmpp
+del muc
+
+
+# preferred mechanisms first
+_mechanisms = [('SCRAM-SHA-256', 'sha256'), ('SCRAM-SHA-1', 'sha1')]
+
+# (mechanism, username, password, salt, iterations) -> (client key, stored key, server key)
+_keys_cache = {}
+_keys_cache_lock = threading.Lock()
+
+
+def get_keys(mechanism, username, password, salt, iterations):
+	"""Returns the client key, stored key and server key of a SCRAM account (RFC 5802).
+
+	The key derivation is deliberately slow, so the keys are computed once per account, salt and iteration count, and shared by all the connections."""
+	key = (mechanism, username, password, salt, iterations)
+	_keys_cache_lock.acquire()
+	keys = _keys_cache.get(key)
+	_keys_cache_lock.release()
+	if keys:
+		return keys
+	hash_name = dict(_mechanisms)[mechanism]
+	digest = getattr(hashlib, hash_name)
+	salted_password = hashlib.pbkdf2_hmac(hash_name, password, salt, iterations)
+	client_key = hmac.new(salted_password, 'Client Key', digest).digest()
+	keys = (client_key, digest(client_key).digest(), hmac.new(salted_password, 'Server Key', digest).digest())
+	_keys_cache_lock.acquire()
+	_keys_cache[key] = keys
+	_keys_cache_lock.release()
+	return keys
+
+
+def _escape(username):
+	return username.replace('=', '=3D').replace(',', '=2C')
+
+
+class SASL(xmpp.auth.SASL):
+	"""xmpp.auth.SASL with the SCRAM-SHA-256 and SCRAM-SHA-1 mechanisms.
+
+	The salted passwords are cached, see get_keys. When the server offers no SCRAM mechanism the mechanisms of xmpp.auth.SASL are used."""
+
+	def FeaturesHandler(self, conn, feats):
+		mechanisms = feats.getTag('mechanisms', namespace=xmpp.protocol.NS_SASL)
+		if not mechanisms:
+			return xmpp.auth.SASL.FeaturesHandler(self, conn, feats)
+		offered = [m.getData() for m in mechanisms.getTags('mechanism')]
+		for mechanism, hash_name in _mechanisms:
+			if mechanism in offered:
+				break
+		else:
+			return xmpp.auth.SASL.FeaturesHandler(self, conn, feats)
+		self.mechanism = mechanism
+		self.client_nonce = base64.b64encode(os.urandom(18))
+		self.client_first_bare = 'n='+_escape(self.username.encode('utf-8'))+',r='+self.client_nonce
+		self.server_signature = None
+		self.server_verified = False
+		self._owner.RegisterHandler('challenge', self.SASLHandler, xmlns=xmpp.protocol.NS_SASL)
+		self._owner.RegisterHandler('failure', self.SASLHandler, xmlns=xmpp.protocol.NS_SASL)
+		self._owner.RegisterHandler('success', self.SASLHandler, xmlns=xmpp.protocol.NS_SASL)
+		self.startsasl = 'in-process'
+		node = xmpp.simplexml.Node('auth', attrs={'xmlns': xmpp.protocol.NS_SASL, 'mechanism': mechanism}, payload=[base64.b64encode('n,,'+self.client_first_bare)])
+		self._owner.send(node.__str__())
+		raise xmpp.protocol.NodeProcessed
+
+
+	def SASLHandler(self, conn, challenge):
+		if challenge.getNamespace() != xmpp.protocol.NS_SASL or not hasattr(self, 'mechanism'):
+			return xmpp.auth.SASL.SASLHandler(self, conn, challenge)
+		if challenge.getName() == 'success':
+			data = base64.b64decode(challenge.getData() or '')
+			# the server-final message comes with the success or in a challenge before it
+			if not (data and self._verify_server_final(data) or not data and self.server_verified):
+				# the server does not know the password, it is not the one we think
+				self.startsasl = 'failure'
+				raise xmpp.protocol.NodeProcessed
+			return xmpp.auth.SASL.SASLHandler(self, conn, challenge)
+		if challenge.getName() != 'challenge':
+			return xmpp.auth.SASL.SASLHandler(self, conn, challenge)
+		if self.server_signature != None:
+			# some servers send the server-final message in a challenge and an empty success
+			if self.server_verified or not self._verify_server_final(base64.b64decode(challenge.getData() or '')):
+				self.startsasl = 'failure'
+				raise xmpp.protocol.NodeProcessed
+			self.server_verified = True
+			node = xmpp.simplexml.Node('response', attrs={'xmlns': xmpp.protocol.NS_SASL})
+			self._owner.send(node.__str__())
+			raise xmpp.protocol.NodeProcessed
+
+		server_first = base64.b64decode(challenge.getData())
+		attributes = dict(a.split('=', 1) for a in server_first.split(',') if '=' in a)
+		nonce = attributes.get('r', '')
+		if not nonce.startswith(self.client_nonce) or not attributes.has_key('s') or not attributes.has_key('i'):
+			self.startsasl = 'failure'
+			raise xmpp.protocol.NodeProcessed
+		digest = getattr(hashlib, dict(_mechanisms)[self.mechanism])
+		client_key, stored_key, server_key = get_keys(self.mechanism, self.username, self.password.encode('utf-8'), base64.b64decode(attributes['s']), int(attributes['i']))
+		client_final = 'c=biws,r='+nonce
+		auth_message = self.client_first_bare+','+server_first+','+client_final
+		client_signature = hmac.new(stored_key, auth_message, digest).digest()
+		proof = ''.join([chr(ord(a) ^ ord(b)) for a, b in zip(client_key, client_signature)])
+		self.server_signature = hmac.new(server_key, auth_message, digest).digest()
+		node = xmpp.simplexml.Node('response', attrs={'xmlns': xmpp.protocol.NS_SASL}, payload=[base64.b64encode(client_final+',p='+base64.b64encode(proof))])
+		self._owner.send(node.__str__())
+		raise xmpp.protocol.NodeProcessed
+
+
+	def _verify_server_final(self, data):
+		"""[Internal] Returns True if the server-final message data proves that the server knows the password."""
+		if self.server_signature == None:
+			return False
+		attributes = dict(a.split('=', 1) for a in data.split(',') if '=' in a)
+		return hmac.compare_digest(attributes.get('v', ''), base64.b64encode(self.server_signature))
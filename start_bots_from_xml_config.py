@@ -24,6 +24,7 @@ import traceback
 
 from admin import Admin
 from bot import Bot
+from component import Component
 import say_levels
 
 
@@ -63,8 +64,45 @@ for bot_el in config.getElementsByTagName('bot'):
 				admin.say_level = say_levels.warning
 			admins.append(admin)
 	
-	bot = Bot(bot_el.getAttribute('jid'), bot_el.getAttribute('password'), bot_el.getAttribute('nickname'), admins=admins, debug=debug)
+	component = None
+	for component_el in bot_el.getElementsByTagName('component'):
+		port = 5347
+		if component_el.hasAttribute('port'):
+			try:
+				port = int(component_el.getAttribute('port'))
+			except ValueError:
+				print '[Error] the value of port must be an integer'
+		server = None
+		if component_el.hasAttribute('server'):
+			server = component_el.getAttribute('server')
+		component = Component(component_el.getAttribute('jid'), component_el.getAttribute('secret'), component_el.getAttribute('host'), port=port, server=server)
+	
+	xmpp_pool_size = 0
+	if bot_el.hasAttribute('xmpp_pool_size'):
+		try:
+			xmpp_pool_size = int(bot_el.getAttribute('xmpp_pool_size'))
+		except ValueError:
+			print '[Error] the value of xmpp_pool_size must be an integer'
+	
+	bot = Bot(bot_el.getAttribute('jid'), bot_el.getAttribute('password'), bot_el.getAttribute('nickname'), admins=admins, debug=debug, component=component, xmpp_pool_size=xmpp_pool_size)
 	bots.append(bot)
+	for link_el in bot_el.getElementsByTagName('irc-link'):
+		port = 6667
+		if link_el.hasAttribute('port'):
+			try:
+				port = int(link_el.getAttribute('port'))
+			except ValueError:
+				print '[Error] the value of port must be an integer'
+		link_port = None
+		if link_el.hasAttribute('link_port'):
+			try:
+				link_port = int(link_el.getAttribute('link_port'))
+			except ValueError:
+				print '[Error] the value of link_port must be an integer'
+		link_server = None
+		if link_el.hasAttribute('link_server'):
+			link_server = link_el.getAttribute('link_server')
+		bot.irc.open_link(link_el.getAttribute('server'), port, link_el.getAttribute('name'), link_el.getAttribute('sid'), link_el.getAttribute('password'), link_server=link_server, link_port=link_port)
 	for bridge_el in bot_el.getElementsByTagName('bridge'):
 		xmpp_room = bridge_el.getElementsByTagName('xmpp-room')[0]
 		irc = bridge_el.getElementsByTagName('irc')[0]
@@ -75,6 +113,24 @@ for bot_el in config.getElementsByTagName('bot'):
 				irc_connection_interval = float(irc.getAttribute('connection_interval'))
 			except ValueError:
 				print '[Error] the value of connection_interval must be a number'
+		irc_connect_timeout = None
+		if irc.hasAttribute('connect_timeout'):
+			try:
+				irc_connect_timeout = float(irc.getAttribute('connect_timeout'))
+			except ValueError:
+				print '[Error] the value of connect_timeout must be a number'
+		irc_flood_burst = None
+		if irc.hasAttribute('flood_burst'):
+			try:
+				irc_flood_burst = int(irc.getAttribute('flood_burst'))
+			except ValueError:
+				print '[Error] the value of flood_burst must be an integer'
+		irc_flood_rate = None
+		if irc.hasAttribute('flood_rate'):
+			try:
+				irc_flood_rate = float(irc.getAttribute('flood_rate'))
+			except ValueError:
+				print '[Error] the value of flood_rate must be a number'
 		if irc.hasAttribute('charsets'):
 			irc_charsets = irc.getAttribute('charsets').split()
 		else:
@@ -90,7 +146,7 @@ for bot_el in config.getElementsByTagName('bot'):
 		else:
 			mode = 'bypass'
 		
-		bot.new_bridge(xmpp_room.getAttribute('jid'), irc.getAttribute('chan'), irc.getAttribute('server'), mode, say_level, irc_connection_interval=irc_connection_interval, irc_charsets=irc_charsets)
+		bot.new_bridge(xmpp_room.getAttribute('jid'), irc.getAttribute('chan'), irc.getAttribute('server'), mode, say_level, irc_connection_interval=irc_connection_interval, irc_connect_timeout=irc_connect_timeout, irc_flood_burst=irc_flood_burst, irc_flood_rate=irc_flood_rate, irc_charsets=irc_charsets)
 
 try:
 	if len(bots) == 0:
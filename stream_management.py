@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import collections
+import socket
+
+import muc
+xmpp = muc.xmpp
+del muc
+
+import scram
+
+
+NS_SM = 'urn:xmpp:sm:3'
+
+# the counters of handled stanzas wrap at 2**32, see XEP-0198
+_h_modulo = 2**32
+
+
+class StreamManagement(xmpp.client.PlugIn):
+	"""Stream management (XEP-0198) for an xmpp.client.Client.
+
+	Counts the stanzas handled in both directions, answers the acknowledgement requests of the server and keeps the stanzas it has not acknowledged yet, so that after a disconnection the session can be resumed and those stanzas sent again instead of opening a new session and rejoining the rooms.
+
+	Plug it in once the client is authenticated, then call enable."""
+
+	def __init__(self, ack_interval=10):
+		xmpp.client.PlugIn.__init__(self)
+		self._exported_methods = [self.send]
+		self.ack_interval = ack_interval
+		self.enabled = False
+		# the server counts our stanzas from <enable/>, we count its stanzas from <enabled/>, see XEP-0198
+		self.tracking = False
+		self.counting = False
+		self.session_id = None
+		self.resumable = False
+		self.resumed = None
+		self.handled = 0
+		self.acked = 0
+		self.unacked = collections.deque()
+
+
+	def plugin(self, owner):
+		# the dispatcher also sends stanzas by itself, for example the replies of SendAndCallForResponse
+		self._dispatcher_send = owner.Dispatcher.send
+		owner.Dispatcher.send = self.send
+		for name in ['enabled', 'resumed', 'failed', 'r', 'a']:
+			owner.RegisterHandler(name, getattr(self, '_'+name+'_handler'), xmlns=NS_SM)
+		for name in ['presence', 'message', 'iq']:
+			owner.RegisterHandler(name, self._count_handler, makefirst=1, system=1)
+
+
+	def plugout(self):
+		for name in ['enabled', 'resumed', 'failed', 'r', 'a']:
+			self._owner.UnregisterHandler(name, getattr(self, '_'+name+'_handler'), xmlns=NS_SM)
+		for name in ['presence', 'message', 'iq']:
+			self._owner.UnregisterHandler(name, self._count_handler)
+		if self._owner.Dispatcher.__dict__.get('send') == self.send:
+			del self._owner.Dispatcher.send
+
+
+	def supported(self):
+		"""Returns True if the server announced stream management in the features of the current stream."""
+		features = self._owner.Dispatcher.Stream.features
+		return features != None and features.getTag('sm', namespace=NS_SM) != None
+
+
+	def enable(self):
+		"""Ask the server to enable stream management with resumption, returns False if it does not support it."""
+		if not self.supported():
+			return False
+		self.enabled = False
+		self.session_id = None
+		self.resumable = False
+		self.handled = 0
+		self.acked = 0
+		self.unacked.clear()
+		self.tracking = True
+		self.counting = False
+		self._owner.send('<enable xmlns="'+NS_SM+'" resume="true"/>')
+		return True
+
+
+	def request_ack(self):
+		"""Ask the server how many stanzas it has handled."""
+		if self.enabled:
+			self._owner.send('<r xmlns="'+NS_SM+'"/>')
+
+
+	def resume(self):
+		"""Reconnect and resume the session.
+
+		Returns True if the session has been resumed, the rooms are still joined and the stanzas the server did not acknowledge have been sent again. Returns False if the server refused or the session cannot be resumed, the new stream is then closed and a new session must be opened."""
+		if not self.resumable:
+			return False
+		owner = self._owner
+		self.PlugOut()
+		handlers = owner.Dispatcher.dumpHandlers()
+		for name in ['Bind', 'SASL', 'TLS']:
+			if owner.__dict__.has_key(name):
+				owner.__dict__[name].PlugOut()
+		owner.Dispatcher.PlugOut()
+		if owner.__dict__.has_key('TCPsocket'):
+			owner.TCPsocket.PlugOut()
+		if not owner.connect(server=owner._Server, proxy=owner._Proxy):
+			return False
+		try:
+			if self._resume_stream(owner, handlers):
+				return True
+		except IOError:
+			pass
+		self._close_stream(owner)
+		return False
+
+
+	def _resume_stream(self, owner, handlers):
+		"""[Internal] Authenticate the new stream of owner and ask the server to resume the session on it."""
+		# authenticate without binding a resource, the resumed session keeps its own
+		while not owner.Dispatcher.Stream.features and owner.Process(1): pass
+		scram.SASL(owner._User, owner._Password).PlugIn(owner)
+		if owner.SASL.startsasl == 'not-supported':
+			return False
+		owner.SASL.auth()
+		while owner.SASL.startsasl == 'in-process' and owner.Process(1): pass
+		if owner.SASL.startsasl != 'success':
+			return False
+		while not owner.Dispatcher.Stream.features and owner.Process(1): pass
+		owner.Dispatcher.restoreHandlers(handlers)
+		self.PlugIn(owner)
+		if not self.supported():
+			return False
+
+		self.resumed = None
+		owner.send('<resume xmlns="'+NS_SM+'" h="'+str(self.handled)+'" previd="'+self.session_id+'"/>')
+		while self.resumed == None and owner.Process(1): pass
+		return self.resumed == True
+
+
+	def _close_stream(self, owner):
+		"""[Internal] Close the stream of a failed resumption, Dispatcher.disconnect would wait for the server to close it."""
+		owner.Connection.send('</stream:stream>')
+		# the transport keeps bound methods of the socket, closing it alone would not release it
+		try:
+			owner.Connection._sock.shutdown(socket.SHUT_RDWR)
+		except socket.error:
+			pass
+		owner.Connection.disconnect()
+
+
+	def send(self, stanza):
+		"""Send stanza and keep it until the server acknowledges it."""
+		ID = self._dispatcher_send(stanza)
+		if self.tracking and isinstance(stanza, xmpp.protocol.Protocol) and stanza.getName() in ['presence', 'message', 'iq']:
+			self.unacked.append(stanza)
+			if self.enabled and len(self.unacked) % self.ack_interval == 0:
+				self.request_ack()
+		return ID
+
+
+	def _acknowledged(self, h):
+		"""[Internal] Forget the stanzas acknowledged by the server."""
+		n = (h - self.acked) % _h_modulo
+		for i in xrange(min(n, len(self.unacked))):
+			self.unacked.popleft()
+		self.acked = h
+
+
+	def _count_handler(self, dispatcher, stanza):
+		if self.counting:
+			self.handled = (self.handled + 1) % _h_modulo
+
+
+	def _enabled_handler(self, dispatcher, stanza):
+		self.enabled = True
+		self.counting = True
+		self.handled = 0
+		self.session_id = stanza.getAttr('id')
+		self.resumable = self.session_id != None and stanza.getAttr('resume') in ['true', '1']
+		raise xmpp.protocol.NodeProcessed
+
+
+	def _resumed_handler(self, dispatcher, stanza):
+		self._acknowledged(int(stanza.getAttr('h')))
+		self.resumed = True
+		self.enabled = True
+		pending = list(self.unacked)
+		self.unacked.clear()
+		for s in pending:
+			self.send(s)
+		raise xmpp.protocol.NodeProcessed
+
+
+	def _failed_handler(self, dispatcher, stanza):
+		self.resumed = False
+		self.enabled = False
+		self.tracking = False
+		self.counting = False
+		self.session_id = None
+		self.resumable = False
+		self.unacked.clear()
+		raise xmpp.protocol.NodeProcessed
+
+
+	def _r_handler(self, dispatcher, stanza):
+		self._owner.send('<a xmlns="'+NS_SM+'" h="'+str(self.handled)+'"/>')
+		raise xmpp.protocol.NodeProcessed
+
+
+	def _a_handler(self, dispatcher, stanza):
+		self._acknowledged(int(stanza.getAttr('h')))
+		raise xmpp.protocol.NodeProcessed
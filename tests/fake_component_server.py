@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""A local stand-in for an XMPP server accepting external components (XEP-0114), and a run of Component and ComponentSession against it.
+
+The server checks the handshake of the component and hosts MUC rooms, good enough for the occupants of the sessions to join, talk and leave: joins get the self-presence of the occupant, groupchat messages are sent back to every occupant of the room, nickname conflicts are reported. Run this file to check the handshake, the routing of the stanzas to the sessions, the unavailable presences sent when a session is closed, the keepalive pings, the replacement of a single failed session and the rejoining of the rooms after a reconnection."""
+
+
+import hashlib
+import os
+import socket
+import sys
+import threading
+import time
+import xml.parsers.expat
+from xml.sax.saxutils import escape, quoteattr
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bot
+import component
+import muc
+xmpp = muc.xmpp
+del muc
+
+
+class FakeComponentServer:
+
+	def __init__(self, domain, secret, server_domain):
+		self.domain = domain
+		self.server_domain = server_domain
+		self.secret = secret
+		self.server = socket.socket()
+		self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.server.bind(('127.0.0.1', 0))
+		self.server.listen(5)
+		self.port = self.server.getsockname()[1]
+		self.lock = threading.Lock()
+		self.streams = 0
+		self.stanzas = []
+		# room -> {nickname: occupant JID}
+		self.rooms = {}
+		self.socket = None
+		self.readers = []
+		t = threading.Thread(target=self._serve)
+		t.setDaemon(True)
+		t.start()
+
+
+	def _serve(self):
+		while True:
+			s, address = self.server.accept()
+			t = threading.Thread(target=self._read, args=(s,))
+			t.setDaemon(True)
+			t.start()
+			self.readers.append((s, t))
+
+
+	def _read(self, s):
+		stream = {'id': None, 'depth': 0, 'stack': []}
+		parser = xml.parsers.expat.ParserCreate()
+
+		def start(name, attrs):
+			stream['depth'] += 1
+			if stream['depth'] == 1:
+				self.lock.acquire()
+				self.streams += 1
+				stream['id'] = 'stream%d' % self.streams
+				self.lock.release()
+				s.sendall("<?xml version='1.0'?><stream:stream xmlns:stream='http://etherx.jabber.org/streams' xmlns='jabber:component:accept' from='%s' id='%s'>" % (self.domain, stream['id']))
+				return
+			element = (name, attrs, [], [])
+			if stream['stack']:
+				stream['stack'][-1][2].append(element)
+			stream['stack'].append(element)
+
+		def data(text):
+			if stream['stack']:
+				stream['stack'][-1][3].append(text)
+
+		def end(name):
+			stream['depth'] -= 1
+			if stream['depth'] == 0:
+				s.sendall('</stream:stream>')
+				s.shutdown(socket.SHUT_RDWR)
+				return
+			element = stream['stack'].pop()
+			if stream['depth'] == 1:
+				self._received(s, stream['id'], element)
+
+		parser.StartElementHandler = start
+		parser.CharacterDataHandler = data
+		parser.EndElementHandler = end
+		while True:
+			try:
+				data = s.recv(4096)
+			except socket.error:
+				break
+			if not data:
+				break
+			try:
+				parser.Parse(data)
+			except xml.parsers.expat.ExpatError:
+				break
+
+
+	def _received(self, s, stream_id, element):
+		name, attrs, children, text = element
+		if name == 'handshake':
+			if ''.join(text) == hashlib.sha1(stream_id+self.secret).hexdigest():
+				self.lock.acquire()
+				self.socket = s
+				self.lock.release()
+				s.sendall('<handshake/>')
+			else:
+				s.sendall('<stream:error><not-authorized xmlns="urn:ietf:params:xml:ns:xmpp-streams"/></stream:error></stream:stream>')
+			return
+		self.lock.acquire()
+		self.stanzas.append(element)
+		self.lock.release()
+		frm = attrs.get('from', '')
+		to = attrs.get('to', '')
+		room, _, nickname = to.partition('/')
+		if name == 'presence' and nickname:
+			occupants = self.rooms.setdefault(room, {})
+			if attrs.get('type') == 'unavailable':
+				if occupants.get(nickname) == frm:
+					del occupants[nickname]
+				self.send('<presence from=%s to=%s type="unavailable"/>' % (quoteattr(to), quoteattr(frm)))
+			elif occupants.has_key(nickname) and occupants[nickname] != frm:
+				self.send('<presence from=%s to=%s type="error"><error type="cancel"><conflict xmlns="urn:ietf:params:xml:ns:xmpp-stanzas"/></error></presence>' % (quoteattr(to), quoteattr(frm)))
+			else:
+				occupants[nickname] = frm
+				self.send('<presence from=%s to=%s><x xmlns="http://jabber.org/protocol/muc#user"><status code="110"/></x></presence>' % (quoteattr(to), quoteattr(frm)))
+		elif name == 'message' and attrs.get('type') == 'groupchat':
+			occupants = self.rooms.get(room, {})
+			for n, jid in occupants.items():
+				if jid == frm:
+					break
+			else:
+				return
+			body = [c for c in children if c[0] == 'body']
+			for jid in occupants.values():
+				self.send('<message from=%s to=%s type="groupchat"><body>%s</body></message>' % (quoteattr(room+'/'+n), quoteattr(jid), escape(''.join(body[0][3]))))
+		elif name == 'iq' and attrs.get('type') == 'get' and to == self.server_domain and frm == self.domain:
+			self.send('<iq from=%s to=%s id=%s type="result"/>' % (quoteattr(to), quoteattr(frm), quoteattr(attrs.get('id', ''))))
+
+
+	def received(self, name, **attrs):
+		"""Returns the stanzas named name received with the attributes attrs."""
+		self.lock.acquire()
+		r = [e for e in self.stanzas if e[0] == name and [k for k in attrs if e[1].get(k) != attrs[k]] == []]
+		self.lock.release()
+		return r
+
+
+	def send(self, data):
+		self.socket.sendall(data)
+
+
+	def drop(self):
+		"""Close the stream of the component from the server side."""
+		self.socket.shutdown(socket.SHUT_RDWR)
+		self.socket.close()
+
+
+	def close(self):
+		for s, t in self.readers:
+			try:
+				s.shutdown(socket.SHUT_RDWR)
+			except socket.error:
+				pass
+			t.join()
+
+
+class FakeBot(bot.Bot):
+	"""A Bot reduced to its XMPP connections, the XMPP loop is run by the test."""
+
+	def __init__(self, component):
+		self.nickname = 'xib'
+		self.debug = False
+		self.bridges = []
+		self.xmpp_connections = {}
+		self.xmpp_c = None
+		self.xmpp_reactor = bot.irclib.default_reactor()
+		self.xmpp_waker = bot.irclib.Waker()
+		self.xmpp_timers = bot.irclib.TimerQueue(self.xmpp_waker)
+		self.xmpp_ping_interval = 60
+		self.xmpp_pool = []
+		self.xmpp_pool_condition = threading.Condition()
+		self.component = component
+
+	def error(self, *args, **kwargs):
+		pass
+
+
+def wait(c, condition, what, timeout=5):
+	end = time.time() + timeout
+	while not condition():
+		if time.time() > end:
+			raise AssertionError('timed out waiting for '+what)
+		c.Process(0.05)
+
+
+def main():
+	domain = 'irc.example.net'
+	room = 'room@muc.example.net'
+	server = FakeComponentServer(domain, 'secret', 'example.net')
+
+	# the handshake
+	c = component.Component(domain, 'wrong', '127.0.0.1', server.port)
+	try:
+		c.open()
+		raise AssertionError('authenticated with a wrong secret')
+	except (component.Component.AuthenticationFailed, IOError):
+		pass
+	c = component.Component(domain, 'secret', '127.0.0.1', server.port)
+	c.open()
+
+	# the occupants of the sessions join the room
+	joins = []
+	foo = c.open_session(u'Foo')
+	bar = c.open_session(u'b@r')
+	assert unicode(bar.jid) == u'b\\40r@irc.example.net/xib', bar.jid
+	messages = []
+	for session in [foo, bar]:
+		session.RegisterHandler('message', lambda dispatcher, message: messages.append((dispatcher.nickname, message.getFrom().getResource(), message.getBody())))
+	foo_muc = xmpp.muc(room)
+	foo_muc.join(foo, u'Foo', status='From IRC', callback=lambda errors: joins.append(('Foo', errors)))
+	bar_muc = xmpp.muc(room)
+	bar_muc.join(bar, u'bar', status='From IRC', callback=lambda errors: joins.append(('bar', errors)))
+	wait(c, lambda: len(joins) == 2, 'the joins of Foo and bar')
+	assert joins == [('Foo', []), ('bar', [])], joins
+	assert server.received('presence', to=room+'/Foo', **{'from': 'foo@irc.example.net/xib'})
+	assert foo_muc.state == foo_muc.JOINED and bar_muc.state == bar_muc.JOINED
+
+	# a nickname conflict
+	baz = c.open_session(u'baz')
+	baz_muc = xmpp.muc(room)
+	baz_muc.join(baz, u'Foo', callback=lambda errors: joins.append(('baz', errors)))
+	wait(c, lambda: len(joins) == 3, 'the nickname conflict of baz')
+	assert isinstance(joins[2][1][0], xmpp.muc.NicknameConflict), joins[2]
+
+	# the stanzas are routed to the session they are addressed to
+	foo_muc.say(u'hello')
+	wait(c, lambda: len(messages) == 2, 'the message of Foo')
+	assert sorted(messages) == [(u'Foo', u'Foo', u'hello'), (u'b@r', u'Foo', u'hello')], messages
+
+	# closing a session makes its occupants leave, the server does not do it for components
+	c.close_session(bar)
+	wait(c, lambda: server.received('presence', to=room+'/bar', type='unavailable'), 'the departure of bar')
+	assert not c.sessions.has_key(bar.node)
+	assert server.rooms[room] == {'Foo': 'foo@irc.example.net/xib'}, server.rooms
+
+	# the keepalive pings of the component are addressed to the server
+	b = FakeBot(c)
+	b._xmpp_ping(c)
+	wait(c, lambda: server.received('iq', to='example.net', **{'from': domain}), 'the ping of the component')
+
+	# when a single session fails only its own occupants rejoin
+	qux = b.get_xmpp_connection(u'Qux')
+	qux_muc = xmpp.muc(room)
+	qux_muc.join(qux, u'Qux', callback=lambda errors: joins.append(('Qux', errors)))
+	wait(c, lambda: len(joins) == 4, 'the join of Qux')
+	presences = len(server.received('presence'))
+	new_qux = b.reopen_xmpp_connection(qux)
+	assert new_qux is not qux and new_qux.jid == qux.jid and b.xmpp_connections[u'Qux'] is new_qux
+	assert qux_muc.xmpp_c is new_qux and new_qux.mucs == [qux_muc]
+	wait(c, lambda: qux_muc.state == qux_muc.JOINED, 'the rejoin of Qux')
+	assert len(server.received('presence')) == presences + 1, server.received('presence')[presences:]
+	assert server.streams == 2, server.streams
+
+	# after a reconnection the rooms of the sessions are joined again
+	server.drop()
+	count = len(server.received('presence', to=room+'/Foo', **{'from': 'foo@irc.example.net/xib'}))
+	c.reconnect()
+	wait(c, lambda: len(server.received('presence', to=room+'/Foo', **{'from': 'foo@irc.example.net/xib'})) > count, 'the join of Foo on the new stream')
+	assert server.streams == 3, server.streams
+
+	c.disconnect()
+	server.close()
+
+	print 'OK'
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""A minimal TS6 hub, and a run of ServerLink and PseudoClient against it.
+
+The hub accepts connections on a local port, records the lines it receives and sends whatever the test tells it to, it does not route anything by itself. Run this file to check the burst, the introduction of the pseudo-clients, joins, the routing of private messages, nick collisions (SAVE and KILL) and the recovery after the loss of the link."""
+
+
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import irclib
+
+
+HUB_SID = '00A'
+
+
+class FakeBot:
+
+	nickname = 'xib'
+
+	def error(self, *args, **kwargs):
+		pass
+
+
+class FakeHub:
+
+	def __init__(self):
+		self.server = socket.socket()
+		self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.server.bind(('127.0.0.1', 0))
+		self.server.listen(5)
+		self.port = self.server.getsockname()[1]
+		self.lock = threading.Lock()
+		self.lines = []
+		self.links = 0
+		self.uids = {}
+		self.socket = None
+		self.readers = []
+		t = threading.Thread(target=self._serve)
+		t.setDaemon(True)
+		t.start()
+
+
+	def _serve(self):
+		while True:
+			s, address = self.server.accept()
+			self.lock.acquire()
+			self.socket = s
+			self.links += 1
+			self.lock.release()
+			t = threading.Thread(target=self._read, args=(s,))
+			t.setDaemon(True)
+			t.start()
+			self.readers.append((s, t))
+
+
+	def _read(self, s):
+		buf = ''
+		while True:
+			try:
+				data = s.recv(4096)
+			except socket.error:
+				break
+			if not data:
+				break
+			buf += data
+			while '\r\n' in buf:
+				line, buf = buf.split('\r\n', 1)
+				self._received(line)
+
+
+	def _received(self, line):
+		words = line.split(' ')
+		self.lock.acquire()
+		self.lines.append(line)
+		if len(words) > 9 and words[1] == 'UID':
+			self.uids[words[2]] = words[9]
+		self.lock.release()
+
+
+	def received(self, start):
+		"""Returns True if a line starting with start has been received."""
+		self.lock.acquire()
+		r = len([l for l in self.lines if l.startswith(start)]) > 0
+		self.lock.release()
+		return r
+
+
+	def send(self, line):
+		self.socket.sendall(line+'\r\n')
+
+
+	def drop(self):
+		"""Close the link from the hub side."""
+		self.socket.shutdown(socket.SHUT_RDWR)
+		self.socket.close()
+
+
+	def close(self):
+		for s, t in self.readers:
+			try:
+				s.shutdown(socket.SHUT_RDWR)
+			except socket.error:
+				pass
+			t.join()
+
+
+def wait(irc, condition, what, timeout=5):
+	end = time.time() + timeout
+	while not condition():
+		if time.time() > end:
+			raise AssertionError('timed out waiting for '+what)
+		irc.process_once(0.05)
+
+
+def main():
+	hub = FakeHub()
+	irc = irclib.IRC()
+	irc.bot = FakeBot()
+	irc.connection_interval(server='127.0.0.1:'+str(hub.port), seconds=0.1)
+	events = []
+	irc.add_global_handler('all_events', lambda c, e: events.append((c.nickname, e.eventtype(), e.source(), e.target(), e.arguments())))
+	def got(nickname, eventtype):
+		return [e for e in events if e[0] == nickname and e[1] == eventtype]
+
+	link = irc.open_link('irc.example.org', 6667, 'xib.example.net', '42X', 'secret', link_server='127.0.0.1', link_port=hub.port)
+	assert irc.get_link('irc.example.org', 6667) is link
+
+	# burst and introduction of the pseudo-clients
+	callbacks = []
+	foo = link.open_client('Foo')
+	assert link.open_client('Foo') is foo
+	foo.connect(nick_callback=lambda error, arguments=None: callbacks.append(('Foo', error)))
+	wait(irc, lambda: hub.uids.has_key('Foo'), 'the introduction of Foo')
+	for start in ['PASS secret TS 6 :42X', 'CAPAB ', 'SERVER xib.example.net 1 ', 'SVINFO 6 6 0 ', ':42X UID Foo 1 ']:
+		assert hub.received(start), start
+	assert callbacks == [('Foo', None)], callbacks
+	hub.send('PASS secret TS 6 :'+HUB_SID)
+	hub.send('SERVER hub.example.org 1 :hub')
+	hub.send(':'+HUB_SID+' UID alice 1 1 +i al example.org 0 00AAAAAAB :Alice')
+	hub.send('PING :hub.example.org')
+	wait(irc, lambda: hub.received(':42X PONG xib.example.net :hub.example.org'), 'the answer to the ping of the hub')
+	assert link.get_server_name() == 'hub.example.org'
+	assert link.users['00AAAAAAB'] == 'alice!al@example.org'
+
+	# joins are not acknowledged by the hub
+	joined = []
+	foo.join('#room', callback=lambda channel, error: joined.append((channel, error)))
+	wait(irc, lambda: hub.received(':'+hub.uids['Foo']+' JOIN '), 'the join of Foo')
+	assert joined == [('#room', None)], joined
+	foo.privmsg('#room', 'hello')
+	wait(irc, lambda: hub.received(':'+hub.uids['Foo']+' PRIVMSG #room :hello'), 'the message of Foo')
+
+	# private messages are routed to the pseudo-client they are addressed to, by UID or by nickname
+	hub.send(':00AAAAAAB PRIVMSG '+hub.uids['Foo']+' :hi \x02there\x02')
+	hub.send(':00AAAAAAB PRIVMSG foo :\x01ACTION waves\x01')
+	hub.send(':00AAAAAAB NOTICE 42XAZZZZZ :nobody')
+	wait(irc, lambda: got('Foo', 'action'), 'the action sent to Foo')
+	assert got('Foo', 'privmsg') == [('Foo', 'privmsg', 'alice!al@example.org', 'Foo', ['hi there'])], got('Foo', 'privmsg')
+	assert got('Foo', 'action')[0][2:] == ('alice!al@example.org', 'Foo', ['waves'])
+	assert not got('Foo', 'privnotice')
+	hub.send(':00AAAAAAB NICK alicia :2')
+	hub.send(':00AAAAAAB PRIVMSG Foo :renamed')
+	wait(irc, lambda: len(got('Foo', 'privmsg')) == 2, 'the second message sent to Foo')
+	assert got('Foo', 'privmsg')[1][2] == 'alicia!al@example.org'
+
+	# nick collisions, the network keeps the other user
+	bar = link.open_client('bar')
+	bar.connect()
+	baz = link.open_client('baz')
+	baz.connect()
+	wait(irc, lambda: hub.uids.has_key('bar') and hub.uids.has_key('baz'), 'the introduction of bar and baz')
+	hub.send(':'+HUB_SID+' SAVE '+hub.uids['bar']+' 1')
+	wait(irc, lambda: got('bar', 'nickcollision'), 'the collision of bar')
+	wait(irc, lambda: hub.received(':'+hub.uids['bar']+' QUIT :Nick collision'), 'the quit of bar')
+	hub.send(':'+HUB_SID+' KILL '+hub.uids['baz']+' :collision')
+	wait(irc, lambda: got('baz', 'nickcollision'), 'the collision of baz')
+	assert not hub.received(':'+hub.uids['baz']+' QUIT')
+	assert not link.clients.has_key(hub.uids['bar']) and not link.clients.has_key(hub.uids['baz'])
+	hub.send(':'+HUB_SID+' KILL 00AAAAAAB :bye')
+	wait(irc, lambda: not link.users.has_key('00AAAAAAB'), 'the kill of alicia')
+
+	# loss of the link, the pseudo-clients are introduced again with their channels
+	hub.uids.clear()
+	hub.drop()
+	wait(irc, lambda: got('Foo', 'disconnect'), 'the disconnection of Foo')
+	assert not foo.connected
+	foo.connect()
+	wait(irc, lambda: hub.links == 2 and hub.uids.has_key('Foo'), 'the introduction of Foo on the new link')
+	wait(irc, lambda: hub.received(':'+hub.uids['Foo']+' JOIN '), 'the join of Foo on the new link')
+	assert foo.connected
+
+	# closing the link while it waits to reconnect must not stop the other connections to its server
+	hub.drop()
+	wait(irc, lambda: len(got('Foo', 'disconnect')) == 2, 'the second disconnection of Foo')
+	wait(irc, lambda: not irc.connection_stacks, 'the end of the connection loop')
+	foo.connect()
+	link.close('bye')
+	c = irc.open_connection('127.0.0.1', hub.port, 'plain')
+	c.connect()
+	wait(irc, lambda: hub.received('NICK plain'), 'the connection of plain')
+	c.close('bye')
+	hub.close()
+
+	print 'OK'
+
+
+if __name__ == '__main__':
+	main()